@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the citation pipeline on synthetic corpora, to tell whether a
+change to merging, deduplication, reporting or saving is safe to ship
+"""
+
+import os
+import sys
+import copy
+import json
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from time import perf_counter
+from contextlib import redirect_stdout
+
+# Add the current directory to the path to import modules
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from util import log, save_data
+from cite import CONFIG
+from modules.source_processor import merge_sources
+from modules.deduplicator import deduplicate_citations, merge_duplicate_groups
+from modules.reporter import generate_reports
+from modules.similarity_store import SimilarityStore
+
+# Benchmark settings
+BENCHMARK = {
+    "sizes": [100, 1000, 10000, 50000],  # Citations per corpus
+    "duplicate_rate": 0.1,  # Share of citations that duplicate an earlier one
+    "near_miss_rate": 0.05,  # Share of citations with a title close to, but not the same as, an earlier one
+    "author_variant_rate": 0.5,  # Share of duplicates whose authors are written differently
+    "repeated_source_rate": 0.1,  # Share of sources listed again by another plugin, merged by id
+    "seed": 0,
+    "repeat": 3,  # Timed runs per corpus, the best is kept to leave out noise
+    "threshold": 0.25,  # Max slowdown (or memory growth) over baseline, as a fraction
+    "min_seconds": 0.01,  # Differences in time below this are noise, never a regression
+    "min_mb": 1,  # Same for memory
+}
+
+# Stages timed, in pipeline order
+STAGES = ["merge_sources", "deduplicate", "merge_duplicate_groups", "generate_reports", "save_data"]
+
+# Letters of synthetic words, with their frequency in English text (%)
+LETTERS = {
+    "e": 12.7, "t": 9.1, "a": 8.2, "o": 7.5, "i": 7.0, "n": 6.7, "s": 6.3, "h": 6.1, "r": 6.0,
+    "d": 4.3, "l": 4.0, "c": 2.8, "u": 2.8, "m": 2.4, "w": 2.4, "f": 2.2, "g": 2.0, "y": 2.0,
+    "p": 1.9, "b": 1.5, "v": 1.0, "k": 0.8, "j": 0.2, "x": 0.2, "q": 0.1, "z": 0.1,
+}
+PUBLISHERS = ["Nature", "Science", "Transportation Research Part B", "IEEE Transactions", "arXiv", "PLOS ONE"]
+PLUGINS = ["sources.py", "orcid.py", "pubmed.py", "google-scholar.py"]
+
+def word(rng, length):
+    """Make a random word of a length"""
+    return "".join(rng.choices(list(LETTERS), weights=list(LETTERS.values()), k=length))
+
+def make_vocabulary(rng, size=3000):
+    """Make words to build titles from"""
+    return sorted({word(rng, rng.randint(2, 12)) for _ in range(size)})
+
+def vary_title(rng, title):
+    """Write a title differently, e.g. as another database would"""
+    variant = rng.choice(["case", "punctuation", "typo"])
+    if variant == "case":
+        return title.upper() if rng.random() < 0.5 else title.lower()
+    if variant == "punctuation":
+        words = title.split()
+        cut = rng.randrange(1, len(words))
+        return " ".join(words[:cut]) + ": " + " ".join(words[cut:]) + "."
+    position = rng.randrange(len(title))
+    return title[:position] + title[position + 1:]
+
+def near_miss_title(rng, title, vocabulary):
+    """Make a title close to another, of a different work"""
+    words = title.split()
+    if rng.random() < 0.5:
+        return title + rng.choice([" Part II", " Revisited", " (Extended Abstract)"])
+    words[rng.randrange(len(words))] = rng.choice(vocabulary)
+    return " ".join(words)
+
+def vary_authors(rng, authors):
+    """Write author names differently, with initials or surname first"""
+    variant = rng.choice(["initials", "surname_first"])
+    varied = []
+    for author in authors:
+        given, family = author.split(" ", 1)
+        if variant == "initials":
+            varied.append(f"{given[0]}. {family}")
+        else:
+            varied.append(f"{family}, {given}")
+    return varied
+
+def make_corpus(size, settings=BENCHMARK):
+    """
+    Make a synthetic corpus of sources and the citations generated from them
+
+    Args:
+        size (int): Number of citations
+        settings (dict): Rates of duplicates, near misses, author variants
+            and repeated sources, and random seed (see BENCHMARK)
+
+    Returns:
+        tuple: (sources, citations)
+    """
+    rng = random.Random(f"{settings['seed']}-{size}")
+    vocabulary = make_vocabulary(rng)
+    names = [word(rng, rng.randint(3, 9)).capitalize() for _ in range(500)]
+
+    citations = []
+    for index in range(size):
+        original = rng.choice(citations) if citations else None
+        roll = rng.random()
+
+        # Same work from another plugin, under the same DOI or another id
+        if original and roll < settings["duplicate_rate"]:
+            citation = dict(original)
+            if rng.random() < 0.5:
+                citation["id"] = f"arxiv:{2000 + index}.{index:05d}"
+                citation["title"] = vary_title(rng, original["title"])
+            if rng.random() < settings["author_variant_rate"]:
+                citation["authors"] = vary_authors(rng, original["authors"])
+            citation["plugin"] = rng.choice(PLUGINS)
+
+        # Different work with a similar title
+        elif original and roll < settings["duplicate_rate"] + settings["near_miss_rate"]:
+            citation = {
+                **original,
+                "id": f"doi:10.{1000 + index % 9000}/bench.{index}",
+                "title": near_miss_title(rng, original["title"], vocabulary),
+                "authors": [f"{rng.choice(names)} {rng.choice(names)}" for _ in range(rng.randint(1, 6))],
+            }
+
+        else:
+            citation = {
+                "id": f"doi:10.{1000 + index % 9000}/bench.{index}",
+                "title": " ".join(rng.choice(vocabulary) for _ in range(rng.randint(5, 14))).capitalize(),
+                "authors": [f"{rng.choice(names)} {rng.choice(names)}" for _ in range(rng.randint(1, 6))],
+                "publisher": rng.choice(PUBLISHERS),
+                "date": f"{rng.randint(1990, 2024)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                "plugin": rng.choice(PLUGINS),
+                "file": "benchmark.yaml",
+            }
+            citation["link"] = f"https://doi.org/{citation['id'][4:]}"
+        citations.append(citation)
+
+    # Sources the citations came from, some listed by more than one plugin
+    sources = []
+    for citation in citations:
+        source = {"id": citation["id"], "plugin": citation["plugin"], "file": citation["file"]}
+        sources.append(source)
+        if rng.random() < settings["repeated_source_rate"]:
+            sources.append({**source, "plugin": rng.choice(PLUGINS), "tags": ["repeated"]})
+
+    return sources, citations
+
+def run_stages(sources, citations, workdir, stages, measure):
+    """
+    Run each pipeline stage on fresh copies of its input
+
+    Args:
+        sources (list): Synthetic sources
+        citations (list): Synthetic citations
+        workdir (str): Directory to write reports and output to
+        stages (dict): Stage name to dict to add results to
+        measure (function): Runs a function, adding its cost to a stage's results
+    """
+    measure(stages["merge_sources"], merge_sources, copy.deepcopy(sources))
+
+    store = SimilarityStore(
+        citations,
+        floor=CONFIG["similarity_report_floor"],
+        top_k=CONFIG["similarity_report_top_k"],
+        spill_after=CONFIG["similarity_spill_after"],
+        spill_dir=workdir,
+    )
+    try:
+        deduplicated, groups, similarity_matrix, group_details = measure(
+            stages["deduplicate"],
+            deduplicate_citations,
+            citations,
+            CONFIG["similarity_threshold"],
+            store,
+        )
+
+        # Merge on its own too, it's part of deduplicate above
+        measure(
+            stages["merge_duplicate_groups"],
+            merge_duplicate_groups,
+            [citation.copy() for citation in citations],
+            groups,
+        )
+
+        measure(
+            stages["generate_reports"],
+            generate_reports,
+            workdir,
+            sources,
+            citations,
+            groups,
+            similarity_matrix,
+            group_details,
+            [],
+        )
+    finally:
+        store.close()
+
+    measure(stages["save_data"], save_data, os.path.join(workdir, "citations.yaml"), deduplicated)
+
+def benchmark_size(size, repeat=BENCHMARK["repeat"], memory=True, settings=BENCHMARK):
+    """
+    Benchmark every stage on a corpus of a size
+
+    Time is the best of repeat runs, peak memory is measured in one more run
+    with tracemalloc, which slows code down too much to time it at once.
+
+    Args:
+        size (int): Number of citations in the corpus
+        repeat (int): Number of timed runs
+        memory (bool): Whether to measure peak memory
+        settings (dict): Corpus settings (see BENCHMARK)
+
+    Returns:
+        dict: Stage name to seconds, citations per second and peak MB
+    """
+    sources, citations = make_corpus(size, settings)
+    stages = {stage: {} for stage in STAGES}
+
+    def timed(results, func, *args):
+        start = perf_counter()
+        value = func(*args)
+        seconds = perf_counter() - start
+        results["seconds"] = min(results.get("seconds", seconds), seconds)
+        return value
+
+    def traced(results, func, *args):
+        tracemalloc.start()
+        try:
+            value = func(*args)
+            results["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        finally:
+            tracemalloc.stop()
+        return value
+
+    # Pipeline logs every merge, keep terminal output out of the timings
+    with tempfile.TemporaryDirectory(prefix="cite-benchmark-") as workdir, open(os.devnull, "w") as null:
+        with redirect_stdout(null):
+            for _ in range(repeat):
+                run_stages(sources, citations, workdir, stages, timed)
+            if memory:
+                run_stages(sources, citations, workdir, stages, traced)
+
+    for results in stages.values():
+        results["throughput"] = size / results["seconds"] if results["seconds"] else None
+
+    return stages
+
+def compare(results, baseline, threshold, min_seconds, min_mb):
+    """
+    Compare results with a baseline of the same stages and sizes
+
+    Args:
+        results (dict): Size to stage results, see benchmark_size
+        baseline (dict): Same, from an earlier run
+        threshold (float): Max increase in time or memory, as a fraction
+        min_seconds (float): Min increase in time to count as regression
+        min_mb (float): Min increase in memory to count as regression
+
+    Returns:
+        list: Regression messages
+    """
+    regressions = []
+    for size, stages in results.items():
+        for stage, values in stages.items():
+            old = baseline.get(size, {}).get(stage)
+            if not old:
+                continue
+            for metric, unit, floor in [("seconds", "s", min_seconds), ("peak_mb", " MB", min_mb)]:
+                if values.get(metric) is None or old.get(metric) is None:
+                    continue
+                increase = values[metric] - old[metric]
+                if increase > floor and increase > threshold * old[metric]:
+                    regressions.append(
+                        f"{stage} ({size} citations): {old[metric]:.3f}{unit} -> "
+                        f"{values[metric]:.3f}{unit} ({increase / old[metric]:+.0%})"
+                    )
+    return regressions
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Benchmark the citation pipeline on synthetic corpora")
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=BENCHMARK["sizes"],
+        help="number of citations of each corpus",
+    )
+    parser.add_argument("--repeat", type=int, default=BENCHMARK["repeat"], help="timed runs per corpus, best is kept")
+    parser.add_argument("--no-memory", action="store_true", help="don't measure peak memory")
+    parser.add_argument("--output", metavar="FILE", help="save results to FILE, e.g. to use as baseline")
+    parser.add_argument("--baseline", metavar="FILE", help="compare with results saved by --output")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=BENCHMARK["threshold"],
+        help="fail if a stage gets slower or uses more memory than baseline by this fraction",
+    )
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)["results"]
+
+    results = {}
+    for size in args.sizes:
+        log()
+        log(f"Benchmarking {size} citations")
+
+        stages = benchmark_size(size, args.repeat, not args.no_memory)
+        results[str(size)] = stages
+
+        for stage, values in stages.items():
+            summary = f"{stage}: {values['seconds']:.3f}s"
+            if values["throughput"]:
+                summary += f", {values['throughput']:,.0f} citations/s"
+            if "peak_mb" in values:
+                summary += f", {values['peak_mb']:.1f} MB peak"
+            log(summary, 1)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(
+                {"python": platform.python_version(), "settings": BENCHMARK, "results": results},
+                file,
+                indent=2,
+            )
+        log()
+        log(f"Results saved to {args.output}")
+
+    if baseline is not None:
+        log()
+        log(f"Comparing with {args.baseline}")
+        regressions = compare(results, baseline, args.threshold, BENCHMARK["min_seconds"], BENCHMARK["min_mb"])
+        for regression in regressions:
+            log(regression, 1, "ERROR")
+        if regressions:
+            log(f"{len(regressions)} regression(s) over {args.threshold:.0%}", level="ERROR")
+            log("\n")
+            exit(1)
+        log("No regressions", level="SUCCESS")
+
+    log("\n")
+
+if __name__ == "__main__":
+    main()
@@ -5,18 +5,28 @@ Main citation processing script with improved duplicate detection and logging
 
 import os
 import sys
+import json
 import atexit
+import shutil
+import argparse
+import tempfile
 from pathlib import Path
 
 # Add the current directory to the path to import modules
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from util import log, save_data
-from modules.logging_module import setup_logging, close_logging, log_to_file
+from util import log, save_data, configure_cache, close_cache, cache_stats, retry_failures, failures
+from modules.logging_module import setup_logging, close_logging
 from modules.source_processor import process_sources
 from modules.citation_generator import generate_citations
 from modules.deduplicator import deduplicate_citations
 from modules.reporter import generate_reports
+from modules.similarity_store import SimilarityStore
+from modules.manifest import Manifest
+from modules.dedup_index import DedupIndex, MODES as DEDUP_MODES
+from modules.run_stats import RunStats
+import replay
+import http_trace
 
 # Configuration
 CONFIG = {
@@ -24,118 +34,298 @@ CONFIG = {
     "report_dir": "_cite/report",
     "plugins": ["pubmed", "orcid", "google-scholar", "sources", "eid"],  # Added 'eid' plugin
     "similarity_threshold": 0.95,  # Higher threshold to avoid false positives
+    "similarity_report_floor": 0.9,  # Min title similarity of pairs listed in report, lower compares more pairs
+    "similarity_report_top_k": 5,  # Max pairs listed in report per citation
+    "similarity_spill_after": 200000,  # Max pairs held in memory before moving to disk
     "text_report": "_cite/report/deduplication_summary.txt",
     "html_report": "_cite/report/citation_report.html",
-    "log_file": "_cite/report/citation_processing.log"
+    "log_file": "_cite/report/citation_processing.log",
+    "log_level": "INFO",  # Min level shown on console: INFO, SUCCESS, WARNING or ERROR
+    "log_file_level": "INFO",  # Min level written to log file
+    "log_flush_interval": 1.0,  # Max seconds between log file flushes, warnings and errors are flushed right away
+    "cache_stats_file": "_cite/report/cache_stats.json",
+    "run_summary_file": "_cite/report/run_summary.json",  # Time and memory of each stage and plugin
+    "network_trace_file": "_cite/report/network_trace.jsonl",  # One line per outbound request
+    "trace_memory": True,  # Trace Python allocations while sources are compiled, for memory per plugin, later stages get peak RSS only. "all" traces every stage, several times slower
+    "max_workers": 8,  # Max plugin entries expanded at once
+    "plugin_concurrency": {  # Max entries expanded at once per plugin, to respect API rate limits
+        "default": 4,
+        "pubmed": 2,
+        "google-scholar": 2,
+        "eid": 2,
+    },
+    "citation_workers": 8,  # Max Manubot lookups at once, 1 to cite in a single batch
+    "resolver_concurrency": {  # Max Manubot lookups at once per resolver host
+        "default": 4,
+        "doi.org": 4,
+        "ncbi": 2,
+        "arxiv": 1,
+    },
+    "manifest_file": "_cite/.cache/manifest.pickle",  # Results of last run, for incremental runs
+    "incremental_ttl": {  # Max age in seconds of reused results per plugin, None for no limit
+        "default": 1 * (60 * 60 * 24),  # metasources, same as plugin API caches
+        "sources": 90 * (60 * 60 * 24),  # same as Manubot cache
+    },
+    "dedup_index_file": "_cite/.cache/dedup_index.pickle",  # Title scores of last run, for incremental dedup
+    "cache": {  # Cache of network requests, expired and evicted at end of run
+        "path": "_cite/.cache",  # relative to repo root
+        "size_limit": 2**30,  # bytes
+        "eviction_policy": "least-recently-stored",  # see diskcache eviction policies
+        "failure_expire": 3 * (60 * 60 * 24),  # seconds to skip ids that failed to look up, 0 to always retry
+    },
 }
 
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Generate citations from data files")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="reprocess every entry and source instead of reusing unchanged results of last run",
+    )
+    parser.add_argument(
+        "--dedup",
+        choices=DEDUP_MODES,
+        default="incremental",
+        help="score only new titles against the dedup index of last run (incremental), "
+        "rebuild the index from scratch (rebuild, implied by --full), "
+        "or check the index against a full comparison (verify)",
+    )
+    parser.add_argument(
+        "--retry",
+        action="append",
+        default=[],
+        metavar="ID",
+        help="look up ID again even if it failed recently (can be repeated)",
+    )
+    parser.add_argument(
+        "--record",
+        metavar="FILE",
+        help="save all http requests and responses of this run to archive FILE",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="FILE",
+        help="answer http requests from archive FILE made with --record, without network",
+    )
+    parser.add_argument(
+        "--replay-latency",
+        metavar="SECONDS",
+        help='with --replay, wait SECONDS per request, or "recorded" to wait as long as when recorded',
+    )
+    args = parser.parse_args()
+    if args.record and args.replay:
+        parser.error("--record and --replay can't be used together")
+    if args.replay_latency not in (None, "recorded"):
+        try:
+            float(args.replay_latency)
+        except ValueError:
+            parser.error('--replay-latency must be a number of seconds or "recorded"')
+    return args
+
 def main():
+    args = parse_args()
+    
     # Ensure report directory exists
     os.makedirs(CONFIG["report_dir"], exist_ok=True)
     
     # Set up logging to both console and file
-    setup_logging(CONFIG["log_file"])
+    setup_logging(
+        CONFIG["log_file"], CONFIG["log_level"], CONFIG["log_file_level"], CONFIG["log_flush_interval"]
+    )
     
     # Register cleanup function to close log file on exit
     atexit.register(close_logging)
     
+    # Time and memory of each stage, saved at exit so failed runs are covered too
+    run_stats = RunStats(CONFIG["trace_memory"])
+    atexit.register(run_stats.close)
+    atexit.register(run_stats.save, CONFIG["run_summary_file"])
+    
+    # Record or replay http traffic, with results of earlier runs kept apart
+    # so every request is really made (recorded) or answered from archive (replayed)
+    if args.record or args.replay:
+        isolated = tempfile.mkdtemp(prefix="cite-")
+        atexit.register(shutil.rmtree, isolated, ignore_errors=True)
+        CONFIG["cache"]["path"] = isolated
+        CONFIG["manifest_file"] = os.path.join(isolated, "manifest.pickle")
+        CONFIG["dedup_index_file"] = os.path.join(isolated, "dedup_index.pickle")
+    if args.record:
+        atexit.register(replay.record(args.record))
+        log(f"Recording http traffic to {args.record}")
+    if args.replay:
+        atexit.register(replay.replay(args.replay, args.replay_latency))
+        log(f"Replaying http traffic from {args.replay}")
+    
+    # Trace every outbound request, to see which hosts and ids take longest
+    atexit.register(http_trace.start(CONFIG["network_trace_file"]))
+    
+    # Cache is opened when first needed, and trimmed once at end of run
+    configure_cache(**CONFIG["cache"])
+    atexit.register(close_cache)
+    retry_failures(args.retry)
+    
     # Initialize error flag
     error = False
     
+    # Results of last run, reused for unchanged entries unless doing a full run
+    manifest = Manifest(CONFIG["manifest_file"], CONFIG["incremental_ttl"], enabled=not args.full)
+    
     # Process all sources from plugins
     log()
-    log_to_file()
     log("Compiling sources")
-    log_to_file("Compiling sources")
     
-    sources, all_sources, source_error = process_sources(CONFIG["plugins"])
+    with run_stats.stage("sources"):
+        sources, all_sources, source_error = process_sources(
+            CONFIG["plugins"], CONFIG["max_workers"], CONFIG["plugin_concurrency"], manifest, run_stats
+        )
+    run_stats.measure_plugin_memory(CONFIG["plugins"])
     error = error or source_error
     
     if error:
         log("Errors occurred during source processing", level="ERROR")
-        log_to_file("Errors occurred during source processing", level="ERROR")
         exit(1)
     
     log(f"{len(sources)} total source(s) to cite")
-    log_to_file(f"{len(sources)} total source(s) to cite")
     
     # Generate citations from sources
     log()
-    log_to_file()
     log("Generating citations")
-    log_to_file("Generating citations")
     
-    citations, all_citations, citation_error = generate_citations(sources)
+    with run_stats.stage("citations"):
+        citations, all_citations, citation_error = generate_citations(
+            sources, CONFIG["citation_workers"], CONFIG["resolver_concurrency"], manifest
+        )
     error = error or citation_error
     
     if error:
         log("Errors occurred during citation generation", level="ERROR")
-        log_to_file("Errors occurred during citation generation", level="ERROR")
         exit(1)
     
     # Deduplicate citations
     log()
-    log_to_file()
     log("Running deduplication with stricter matching criteria")
-    log_to_file("Running deduplication with stricter matching criteria")
     
-    deduplicated_citations, duplicate_groups, similarity_matrix, group_details = (
-        deduplicate_citations(citations, CONFIG["similarity_threshold"])
+    similarity_store = SimilarityStore(
+        citations,
+        floor=CONFIG["similarity_report_floor"],
+        top_k=CONFIG["similarity_report_top_k"],
+        spill_after=CONFIG["similarity_spill_after"],
     )
+    atexit.register(similarity_store.close)
+    
+    # Title scores of last run, so only new titles are compared
+    dedup_index = DedupIndex(CONFIG["dedup_index_file"], "rebuild" if args.full else args.dedup)
+    
+    with run_stats.stage("deduplication"):
+        deduplicated_citations, duplicate_groups, similarity_matrix, group_details = (
+            deduplicate_citations(citations, CONFIG["similarity_threshold"], similarity_store, dedup_index)
+        )
     
     log(f"Found {len(duplicate_groups)} groups of duplicate citations", 1)
-    log_to_file(f"Found {len(duplicate_groups)} groups of duplicate citations", 1)
     
     if duplicate_groups:
         log(f"Deduplicated citations list now has {len(deduplicated_citations)} entries", 1)
-        log_to_file(f"Deduplicated citations list now has {len(deduplicated_citations)} entries", 1)
         log(f"Removed {sum(len(group) - 1 for group in duplicate_groups)} duplicate citations", 1)
-        log_to_file(f"Removed {sum(len(group) - 1 for group in duplicate_groups)} duplicate citations", 1)
     
     # Generate reports
     log()
-    log_to_file()
     log("Generating detailed reports")
-    log_to_file("Generating detailed reports")
-    
-    generate_reports(
-        CONFIG["report_dir"],
-        all_sources,
-        all_citations,
-        duplicate_groups,
-        similarity_matrix,
-        group_details
-    )
+    
+    with run_stats.stage("reports"):
+        generate_reports(
+            CONFIG["report_dir"],
+            all_sources,
+            all_citations,
+            duplicate_groups,
+            similarity_matrix,
+            group_details,
+            failures(),
+            run_stats.summary(),
+            http_trace.summary(),
+        )
     
     # Save final citations
     log()
-    log_to_file()
     log("Saving updated citations")
-    log_to_file("Saving updated citations")
     
     try:
-        save_data(CONFIG["output_file"], deduplicated_citations)
+        with run_stats.stage("save"):
+            save_data(CONFIG["output_file"], deduplicated_citations)
     except Exception as e:
         log(str(e), level="ERROR")
-        log_to_file(str(e), level="ERROR")
         error = True
     
+    # Save results for next incremental run
+    if not error:
+        try:
+            manifest.save()
+            reused = manifest.stats["reused"]
+            log(f"Reused {reused.get('entries', 0)} unchanged entries and {reused.get('citations', 0)} citations", 1)
+        except Exception as e:
+            log(f"Couldn't save manifest: {e}", 1, "WARNING")
+        try:
+            dedup_index.save()
+        except Exception as e:
+            log(f"Couldn't save dedup index: {e}", 1, "WARNING")
+    
+    # Report cache effectiveness, to help tune expiry times
+    log()
+    log("Cache statistics")
+    
+    stats = cache_stats()
+    for namespace, values in stats.items():
+        summary = (
+            f"{namespace}: {values['hits']} hit(s), {values['misses']} miss(es), "
+            f"{values['hit_rate']:.0%} hit rate, "
+            f"{values['mean_hit_ms']} ms per hit, {values['mean_miss_ms']} ms per miss"
+        )
+        log(summary, 1)
+    
+    try:
+        with open(CONFIG["cache_stats_file"], "w", encoding="utf-8") as file:
+            json.dump(stats, file, indent=2)
+    except Exception as e:
+        log(f"Couldn't save cache statistics: {e}", 1, "WARNING")
+    
+    # Report which hosts requests spent most time on
+    log()
+    log("Network requests")
+    
+    for host, values in http_trace.summary()["hosts"].items():
+        summary = f"{host}: {values['requests']} request(s), {values['cache'].get('hit', 0)} cache hit(s)"
+        if values["requests"]:
+            summary += (
+                f", {values['p50'] * 1000:.0f} ms median, {values['p90'] * 1000:.0f} ms p90, "
+                f"{values['bytes'] / 2**10:.0f} KB, {values['retries']} retries, {values['errors']} error(s)"
+            )
+        log(summary, 1)
+    log(f"Every request saved to {CONFIG['network_trace_file']}", 1)
+    
+    # Report where the time went, to tell which stage slows runs down
+    log()
+    log("Run statistics")
+    
+    for stage, values in run_stats.stages.items():
+        summary = f"{stage}: {values['wall_seconds']}s wall, {values['cpu_seconds']}s CPU"
+        if "allocated_mb" in values:
+            summary += f", {values['peak_allocated_mb']} MB peak allocated"
+        elif "peak_rss_mb" in values:
+            summary += f", {values['peak_rss_mb']} MB peak RSS"
+        log(summary, 1)
+    log(f"Full statistics saved to {CONFIG['run_summary_file']}", 1)
+    
     # Final status
     if error:
         log("Error(s) occurred above", level="ERROR")
-        log_to_file("Error(s) occurred above", level="ERROR")
         exit(1)
     else:
         log("All done!", level="SUCCESS")
-        log_to_file("All done!", level="SUCCESS")
         if duplicate_groups:
             log(f"\nCheck {CONFIG['text_report']} for a detailed deduplication summary", 1)
-            log_to_file(f"\nCheck {CONFIG['text_report']} for a detailed deduplication summary", 1)
             log(f"A full HTML report is available at {CONFIG['html_report']}", 1)
-            log_to_file(f"A full HTML report is available at {CONFIG['html_report']}", 1)
     
     log("\n")
-    log_to_file("\n")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
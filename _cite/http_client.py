@@ -0,0 +1,145 @@
+"""
+shared http client for plugins, with pooled keep-alive connections per host,
+default timeouts, retries with backoff and gzip
+"""
+
+import json
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from util import cache, log, record_cache
+import http_trace
+
+
+# seconds to wait for connecting, and for each read
+TIMEOUT = (5, 30)
+
+# max pooled connections kept per host
+POOL_SIZE = 10
+
+# retry failed connections and rate limited/server error responses,
+# waiting 0.5, 1, 2, 4 seconds (or as long as Retry-After says)
+RETRY = Retry(
+    total=4,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET", "HEAD"],
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
+# headers sent with every request
+HEADERS = {
+    "User-Agent": "tsl-website-cite (+https://github.com/tsl-imperial/tsl-website)",
+    "Accept-Encoding": "gzip, deflate",
+}
+
+
+# seconds to keep stored responses that can be revalidated, after they expire
+KEEP_VALIDATED = 30 * (60 * 60 * 24)
+
+
+# session shared by all plugins and threads, made when first needed
+_session = None
+_session_lock = threading.Lock()
+
+
+def session():
+    """
+    get shared session, whose connection pools are safe to use from threads
+    """
+
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=RETRY
+            )
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+            _session.headers.update(HEADERS)
+        return _session
+
+
+def get(url, params=None, headers=None, timeout=TIMEOUT):
+    """
+    GET url with shared session, raising on error status (after retries)
+    """
+
+    response = session().get(url, params=params, headers=headers, timeout=timeout)
+    response.raise_for_status()
+    return response
+
+
+def get_json(url, params=None, headers=None, timeout=TIMEOUT):
+    """
+    GET url with shared session and parse JSON response
+    """
+
+    return get(url, params=params, headers=headers, timeout=timeout).json()
+
+
+def get_cached(url, params=None, headers=None, expire=1 * (60 * 60 * 24), timeout=TIMEOUT):
+    """
+    GET url, reusing stored response while younger than expire. After that, if
+    the server gave an ETag or Last-Modified validator, ask it whether the
+    response changed (If-None-Match/If-Modified-Since), and on 304 Not Modified
+    keep using the stored response for another expire seconds instead of
+    downloading it again.
+    """
+
+    key = (
+        "http",
+        url,
+        tuple(sorted((params or {}).items())),
+        tuple(sorted((headers or {}).items())),
+    )
+    start = time.perf_counter()
+    stored = cache.get(key, default=None, retry=True)
+    if stored and time.time() - stored["time"] < expire:
+        record_cache("http", True, time.perf_counter() - start)
+        http_trace.record_hit(url, time.perf_counter() - start)
+        return stored["content"]
+
+    # ask only for changes to stored response
+    conditional = dict(headers or {})
+    if stored and stored["etag"]:
+        conditional["If-None-Match"] = stored["etag"]
+    if stored and stored["last_modified"]:
+        conditional["If-Modified-Since"] = stored["last_modified"]
+
+    outcome = "conditional" if len(conditional) > len(headers or {}) else "miss"
+    with http_trace.cache_outcome(outcome):
+        response = session().get(url, params=params, headers=conditional, timeout=timeout)
+
+    # revalidated response counts as hit, its body wasn't downloaded again
+    revalidated = stored and response.status_code == 304
+    if revalidated:
+        log(" (not modified)", level="INFO", newline=False)
+        record = {**stored, "time": time.time()}
+    else:
+        response.raise_for_status()
+        record = {
+            "content": response.content,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "time": time.time(),
+        }
+
+    # without validators, stored response is of no use once expired
+    validated = record["etag"] or record["last_modified"]
+    cache.set(key, record, expire=KEEP_VALIDATED if validated else expire, retry=True)
+    record_cache("http", bool(revalidated), time.perf_counter() - start)
+
+    return record["content"]
+
+
+def get_json_cached(url, params=None, headers=None, expire=1 * (60 * 60 * 24), timeout=TIMEOUT):
+    """
+    get_cached and parse JSON response
+    """
+
+    return json.loads(get_cached(url, params=params, headers=headers, expire=expire, timeout=timeout))
@@ -0,0 +1,246 @@
+"""
+trace every outbound http request of a run (plugins, via http_client, and
+Manubot) to a jsonl file, one line per request, to see which calls dominate
+"""
+
+import json
+import math
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+import requests
+
+
+# id being looked up by the current thread, e.g. "doi:10.1234/5678"
+_subject = contextvars.ContextVar("trace_subject", default=None)
+
+# cache outcome of the request about to be sent, set by http_client
+_cache = contextvars.ContextVar("trace_cache", default="uncached")
+
+# whether current thread is already in a traced send, e.g. following redirects
+_sending = contextvars.ContextVar("trace_sending", default=False)
+
+# original send method of requests, while hooked
+_send = None
+
+# open trace file and records of this run
+_file = None
+_records = []
+_lock = threading.Lock()
+
+
+@contextmanager
+def subject(_id):
+    """
+    attribute requests made in this block (on this thread) to id
+    """
+
+    token = _subject.set(_id)
+    try:
+        yield
+    finally:
+        _subject.reset(token)
+
+
+def bind(func):
+    """
+    wrap func to attribute its requests to the current id, wherever it runs,
+    e.g. on worker threads, which don't inherit context
+    """
+
+    _id = _subject.get()
+
+    def bound(*args, **kwargs):
+        with subject(_id):
+            return func(*args, **kwargs)
+
+    return bound
+
+
+@contextmanager
+def cache_outcome(outcome):
+    """
+    mark requests made in this block with cache outcome, "miss" for a request
+    for something not stored, "conditional" for revalidating a stored response
+    (recorded as "revalidated" on 304 Not Modified, "changed" otherwise)
+    """
+
+    token = _cache.set(outcome)
+    try:
+        yield
+    finally:
+        _cache.reset(token)
+
+
+def add(record):
+    """
+    add record to trace, safe to call from threads
+    """
+
+    if _file is None:
+        return
+    with _lock:
+        _records.append(record)
+        _file.write(json.dumps(record) + "\n")
+
+
+def record_hit(url, seconds):
+    """
+    trace response served from cache without any request
+    """
+
+    parts = urlsplit(url)
+    add({
+        "time": time.time(),
+        "host": parts.hostname,
+        "endpoint": parts.path,
+        "method": "GET",
+        "status": None,
+        "seconds": round(seconds, 4),
+        "bytes": 0,
+        "retries": 0,
+        "redirects": 0,
+        "cache": "hit",
+        "subject": _subject.get(),
+        "error": None,
+    })
+
+
+def start(path):
+    """
+    trace requests to jsonl file at path, returns function to stop tracing
+    """
+
+    global _send, _file
+    _send = requests.Session.send
+    _file = open(path, "w", encoding="utf-8")
+    _records.clear()
+
+    def send(session, request, **kwargs):
+        # redirects are sent again from inside the first send, trace that only
+        if _sending.get():
+            return _send(session, request, **kwargs)
+
+        token = _sending.set(True)
+        parts = urlsplit(request.url)
+        outcome = _cache.get()
+        record = {
+            "time": time.time(),
+            "host": parts.hostname,
+            "endpoint": parts.path,
+            "method": request.method,
+            "status": None,
+            "seconds": None,
+            "bytes": None,
+            "retries": None,
+            "redirects": 0,
+            "cache": outcome,
+            "subject": _subject.get(),
+            "error": None,
+        }
+        start = time.perf_counter()
+        try:
+            response = _send(session, request, **kwargs)
+        except Exception as e:
+            record["error"] = type(e).__name__
+            raise
+        else:
+            record["status"] = response.status_code
+            record["redirects"] = len(response.history)
+            # retries made by urllib3, lost if all failed (then error is set)
+            retries = getattr(response.raw, "retries", None)
+            record["retries"] = len(retries.history) if retries else 0
+            # bytes read from network, before decompression, if known. streamed
+            # bodies aren't read yet, and mustn't be read here
+            if kwargs.get("stream"):
+                length = response.headers.get("Content-Length", "")
+                record["bytes"] = int(length) if length.isdigit() else None
+            elif hasattr(response.raw, "tell"):
+                record["bytes"] = response.raw.tell()
+            else:
+                record["bytes"] = len(response.content or b"")
+            if outcome == "conditional":
+                record["cache"] = "revalidated" if response.status_code == 304 else "changed"
+            return response
+        finally:
+            record["seconds"] = round(time.perf_counter() - start, 4)
+            _sending.reset(token)
+            add(record)
+
+    requests.Session.send = send
+
+    def stop():
+        global _file
+        requests.Session.send = _send
+        with _lock:
+            if _file:
+                _file.close()
+                _file = None
+
+    return stop
+
+
+def percentile(values, fraction):
+    """
+    get value at fraction (0-1) of sorted values, nearest rank
+    """
+
+    if not values:
+        return None
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def summary(slowest=10):
+    """
+    aggregate trace of this run into latency percentiles and totals per host,
+    and the ids whose requests took longest in total
+    """
+
+    hosts = {}
+    subjects = {}
+    with _lock:
+        records = list(_records)
+
+    for record in records:
+        host = hosts.setdefault(record["host"], {
+            "requests": 0, "errors": 0, "retries": 0, "bytes": 0, "seconds": [], "cache": {},
+        })
+        host["cache"][record["cache"]] = host["cache"].get(record["cache"], 0) + 1
+        # cache hits made no request, keep them out of network latency
+        if record["cache"] == "hit":
+            continue
+        host["requests"] += 1
+        host["errors"] += bool(record["error"] or (record["status"] or 0) >= 400)
+        host["retries"] += record["retries"] or 0
+        host["bytes"] += record["bytes"] or 0
+        host["seconds"].append(record["seconds"])
+
+        if record["subject"]:
+            item = subjects.setdefault(record["subject"], {"requests": 0, "seconds": 0, "hosts": set()})
+            item["requests"] += 1
+            item["seconds"] += record["seconds"]
+            item["hosts"].add(record["host"])
+
+    for host in hosts.values():
+        seconds = sorted(host.pop("seconds"))
+        host.update({
+            "p50": percentile(seconds, 0.5),
+            "p90": percentile(seconds, 0.9),
+            "p99": percentile(seconds, 0.99),
+            "max": seconds[-1] if seconds else None,
+            "total_seconds": round(sum(seconds), 3),
+        })
+
+    slowest_subjects = [
+        {
+            "subject": _id,
+            "requests": item["requests"],
+            "seconds": round(item["seconds"], 3),
+            "hosts": sorted(item["hosts"]),
+        }
+        for _id, item in sorted(subjects.items(), key=lambda item: -item[1]["seconds"])[:slowest]
+    ]
+
+    return {"hosts": hosts, "slowest": slowest_subjects}
@@ -2,15 +2,31 @@
 Module for generating citations from sources with file logging and improved error handling
 """
 
-from util import log, get_safe, cite_with_manubot, format_date, label
-from modules.logging_module import log_to_file
+import copy
+from util import log, get_safe, cite_with_manubot_batch, format_date, label, create_executors
+from modules.manifest import source_key
 
-def generate_citations(sources):
+# Host that resolves each Manubot id prefix, for per-host concurrency limits
+RESOLVER_HOSTS = {
+    "doi": "doi.org",
+    "pubmed": "ncbi",
+    "pmid": "ncbi",
+    "pmc": "ncbi",
+    "pmcid": "ncbi",
+    "arxiv": "arxiv",
+}
+
+def generate_citations(sources, workers=1, host_concurrency=None, manifest=None):
     """
     Generate citation data from sources
     
     Args:
         sources (list): List of source dictionaries
+        workers (int): Max number of Manubot lookups at once, 1 to cite in a single batch
+        host_concurrency (dict): Max number of lookups at once per resolver host
+            (see RESOLVER_HOSTS), with "default" used for other hosts
+        manifest (Manifest): Results of last run, to reuse for unchanged sources
+            and to record this run's results in
         
     Returns:
         tuple: (citations, all_citations, error_flag)
@@ -24,17 +40,49 @@ def generate_citations(sources):
     # Store all original citations for reporting
     all_citations = []
     
+    # Citations of unchanged sources from last run
+    keys = [source_key(source) for source in sources]
+    reused = [
+        manifest.get("citations", key, get_safe(source, "plugin", "")) if manifest else None
+        for source, key in zip(sources, keys)
+    ]
+    
+    # Cite all ids that need Manubot in one batch up front
+    ids = manubot_ids([source for source, record in zip(sources, reused) if not record])
+    # ids entered by user are looked up every run until they work, only
+    # failures of metasource ids are remembered
+    user_ids = {
+        get_safe(source, "id", "").strip() for source in sources
+        if get_safe(source, "plugin", "") == "sources.py"
+    }
+    if ids:
+        log(f"Using Manubot to generate {len(ids)} citation(s)")
+    if workers > 1:
+        manubot_citations = cite_in_parallel(ids, workers, host_concurrency, user_ids)
+    else:
+        manubot_citations = cite_with_manubot_batch(ids, user_ids)
+    
     # Loop through compiled sources
     for index, source in enumerate(sources):
         log(f"Processing source {index + 1} of {len(sources)}, {label(source)}")
-        log_to_file(f"Processing source {index + 1} of {len(sources)}, {label(source)}")
 
         # If explicitly flagged, remove/ignore entry
         if get_safe(source, "remove", False) == True:
             continue
 
+        # Splice in citation of unchanged source
+        if reused[index]:
+            citation = copy.deepcopy(reused[index]["citation"])
+            log(" (unchanged)", level="INFO", newline=False)
+            all_citations.append(citation.copy())
+            citations.append(citation)
+            continue
+
         # New citation data for source
         citation = {}
+        
+        # Whether citation is a placeholder for a failed lookup
+        failed = False
 
         # Source id
         _id = get_safe(source, "id", "").strip()
@@ -45,14 +93,12 @@ def generate_citations(sources):
             # Just use the source as is
             citation = source
             log(f"Using Google Scholar data for citation: {source.get('title', 'No title')}", 1)
-            log_to_file(f"Using Google Scholar data for citation: {source.get('title', 'No title')}", 1)
         elif _id.startswith("eid:"):
             # For Scopus EIDs, check if we already have the citation data
             if source.get("title") and source.get("authors") and source.get("date"):
                 # If we have complete citation data, use it directly
                 citation = source
                 log(f"Using existing data for Scopus EID citation: {source.get('title', 'No title')}", 1)
-                log_to_file(f"Using existing data for Scopus EID citation: {source.get('title', 'No title')}", 1)
             else:
                 # If data is incomplete, create placeholder to be manually updated
                 citation = {
@@ -64,30 +110,34 @@ def generate_citations(sources):
                     "link": f"https://www.scopus.com/record/display.uri?eid={_id.replace('eid:', '')}"
                 }
                 log(f"Created placeholder for Scopus EID citation: {_id}", 1, level="WARNING")
-                log_to_file(f"Created placeholder for Scopus EID citation: {_id}", 1, level="WARNING")
+        elif _id and has_citation_data(source):
+            # Metasource plugin already fetched full citation details, e.g. in bulk
+            citation = source
+            log(f"Using existing data for citation: {source.get('title', 'No title')}", 1)
         # Manubot doesn't work without an id for other types
         elif _id:
             log("Using Manubot to generate citation", 1)
-            log_to_file("Using Manubot to generate citation", 1)
 
             try:
-                # Run Manubot and set citation
-                citation = cite_with_manubot(_id)
+                # Get Manubot result and set citation
+                result = manubot_citations.get(_id) or Exception("Manubot could not generate citation")
+                if isinstance(result, Exception):
+                    raise result
+                citation = dict(result)
                 log(f"Manubot generated citation: {citation.get('title', 'No title')}", 2)
-                log_to_file(f"Manubot generated citation: {citation.get('title', 'No title')}", 2)
 
             # If Manubot cannot cite source
             except Exception as e:
                 # If regular source (id entered by user), throw error
                 if get_safe(source, "plugin", "") == "sources.py":
                     log(e, 3, "ERROR")
-                    log_to_file(e, 3, "ERROR")
                     error = True
+                    failed = True
                 # Otherwise, if from metasource (id retrieved from some third-party API), just warn
                 else:
                     log(e, 3, "WARNING")
-                    log_to_file(e, 3, "WARNING")
                     # Create a placeholder citation instead of discarding
+                    failed = True
                     citation = {
                         "id": _id,
                         "title": f"[Citation Failed] - ID: {_id}",
@@ -96,7 +146,6 @@ def generate_citations(sources):
                         "date": "2000-01-01"  # Placeholder date
                     }
                     log(f"Created placeholder citation for {_id}", 3, "WARNING")
-                    log_to_file(f"Created placeholder citation for {_id}", 3, "WARNING")
 
         # Preserve fields from input source, overriding existing fields
         citation.update(source)
@@ -105,10 +154,93 @@ def generate_citations(sources):
         if get_safe(citation, "date", ""):
             citation["date"] = format_date(get_safe(citation, "date", ""))
 
+        # Record citation for next run, failed lookups are retried instead
+        if manifest and not failed:
+            manifest.set("citations", keys[index], {"citation": copy.deepcopy(citation)})
+        
         # Store original citation for reporting
         all_citations.append(citation.copy())
         
         # Add new citation to list
         citations.append(citation)
     
-    return citations, all_citations, error
\ No newline at end of file
+    return citations, all_citations, error
+
+def manubot_ids(sources):
+    """
+    Get ids of sources that will be cited with Manubot
+    
+    Args:
+        sources (list): List of source dictionaries
+        
+    Returns:
+        list: Unique source ids, in source order
+    """
+    ids = []
+    for source in sources:
+        if get_safe(source, "remove", False) == True:
+            continue
+        _id = get_safe(source, "id", "").strip()
+        if not _id or _id.startswith(("pyOTFWoAAAAJ:", "gs-id:", "eid:")):
+            continue
+        if has_citation_data(source):
+            continue
+        ids.append(_id)
+    return list(dict.fromkeys(ids))
+
+def has_citation_data(source):
+    """
+    Check if source from a metasource plugin already has the details Manubot
+    would look up, so it can be used as citation directly
+    
+    Args:
+        source (dict): Source dictionary
+        
+    Returns:
+        bool: Whether source has title, authors and date, and isn't from sources.py
+    """
+    if get_safe(source, "plugin", "") == "sources.py":
+        return False
+    return bool(source.get("title") and source.get("authors") and source.get("date"))
+
+def resolver_host(_id):
+    """
+    Get host that Manubot will query to resolve id
+    
+    Args:
+        _id (str): Source id
+        
+    Returns:
+        str: Host name from RESOLVER_HOSTS, or "default"
+    """
+    prefix, _, rest = _id.partition(":")
+    # bare DOIs get their prefix inferred by Manubot
+    if not rest:
+        return "doi.org" if _id.startswith("10.") else "default"
+    return RESOLVER_HOSTS.get(prefix.lower(), "default")
+
+def cite_in_parallel(ids, workers, host_concurrency=None, user_ids=()):
+    """
+    Cite ids with Manubot concurrently, capped per resolver host
+    
+    Args:
+        ids (list): Source ids
+        workers (int): Max number of lookups at once, across all hosts
+        host_concurrency (dict): Max number of lookups at once per resolver host
+        user_ids (set): Ids entered by user, whose failures aren't remembered
+        
+    Returns:
+        dict: Id to citation, or to exception if id could not be cited
+    """
+    hosts = {_id: resolver_host(_id) for _id in ids}
+    executors = create_executors(set(hosts.values()), workers, host_concurrency)
+    
+    try:
+        futures = {
+            _id: executors[host].submit(cite_with_manubot_batch, [_id], user_ids)
+            for _id, host in hosts.items()
+        }
+        return {_id: future.result()[_id] for _id, future in futures.items()}
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=True)
\ No newline at end of file
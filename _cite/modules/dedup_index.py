@@ -0,0 +1,233 @@
+"""
+Module for the persistent deduplication index, which keeps title comparison
+results between runs so only added or changed titles need to be scored
+"""
+
+import os
+import pickle
+from math import ceil
+from pathlib import Path
+from difflib import SequenceMatcher
+
+# bump when the layout of the index changes, to discard old indexes
+VERSION = 1
+
+# index modes
+MODES = ["incremental", "rebuild", "verify"]
+
+class DedupIndex:
+    """
+    Title similarity scores and candidate blocks, persisted between runs
+
+    For every pair of known (normalized) titles whose similarity, in either
+    direction, reaches the cutoff, the exact SequenceMatcher ratio is stored.
+    A pair of known titles without a stored score is below the cutoff. New
+    titles are scored only against titles they share a prefix block with
+    (see deduplicator.candidate_pairs), using a token order that is fixed once
+    assigned, so blocks of known titles never change.
+
+    Modes:
+        incremental: load index from last run and score only new titles
+        rebuild: start from an empty index and score all titles
+        verify: like incremental, but also compare with a from-scratch run
+    """
+
+    def __init__(self, path, mode="incremental"):
+        """
+        Args:
+            path (str): Index file to load from and save to
+            mode (str): One of MODES
+        """
+        if mode not in MODES:
+            raise Exception(f"Unknown dedup index mode {mode}")
+
+        self.path = Path(path)
+        self.mode = mode
+        self.data = self.empty(None)
+        # titles in use this run, everything else is dropped on save
+        self.seen = set()
+        # titles each title has a stored score against, built by update
+        self.partners = {}
+
+        if mode != "rebuild":
+            self.load()
+
+    @staticmethod
+    def empty(cutoff):
+        """Get empty index data for a cutoff"""
+        return {
+            "version": VERSION,
+            "cutoff": cutoff,
+            # rank of each character token, lower is rarer
+            "order": {},
+            # prefix tokens of each known title
+            "titles": {},
+            # known titles by prefix token
+            "postings": {},
+            # (title1, title2) to ratio of SequenceMatcher(None, title1, title2)
+            "scores": {},
+            # titles of citations by DOI, and duplicate groups (by id) from last run
+            "dois": {},
+            "groups": [],
+        }
+
+    def load(self):
+        """Load index from disk, starting empty if missing, invalid or outdated"""
+        try:
+            with open(self.path, "rb") as file:
+                data = pickle.load(file)
+            if data.get("version") == VERSION:
+                self.data = data
+        except Exception:
+            pass
+
+    def save(self):
+        """Write index to disk atomically, dropping titles not seen this run"""
+        data = self.data
+        for title in list(data["titles"]):
+            if title in self.seen:
+                continue
+            for token in data["titles"].pop(title):
+                posting = data["postings"].get(token)
+                if posting is not None:
+                    posting.discard(title)
+                    if not posting:
+                        del data["postings"][token]
+        data["scores"] = {
+            pair: score for pair, score in data["scores"].items()
+            if pair[0] in self.seen and pair[1] in self.seen
+        }
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp = self.path.with_name(self.path.name + ".tmp")
+        with open(temp, "wb") as file:
+            pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, self.path)
+
+    def reset(self, cutoff):
+        """Drop everything, e.g. when the cutoff the scores were kept for changes"""
+        self.data = self.empty(cutoff)
+        self.partners = {}
+
+    def update(self, titles, tokens, cutoff, cascade, stats=None):
+        """
+        Add new titles to the index, scoring them against their candidate blocks
+
+        Args:
+            titles (list): Normalized titles in use this run
+            tokens (function): Character tokens of a normalized title
+            cutoff (float): Ratio at or above which scores are stored
+            cascade (function): deduplicator.cascade_ratio
+            stats (dict): Cascade tier counts to add to
+
+        Returns:
+            int: Number of new titles
+        """
+        if self.data["cutoff"] != cutoff:
+            self.reset(cutoff)
+
+        data = self.data
+        order = data["order"]
+        known = data["titles"]
+        postings = data["postings"]
+        scores = data["scores"]
+
+        self.seen.update(titles)
+        new = sorted({title for title in titles if title and title not in known})
+
+        # rank tokens not seen before, rarest first among new titles
+        frequency = {}
+        for title in new:
+            for token in tokens(title):
+                if token not in order:
+                    frequency[token] = frequency.get(token, 0) + 1
+        for token in sorted(frequency, key=lambda token: (frequency[token], token)):
+            order[token] = len(order)
+
+        min_overlap = cutoff / (2 - cutoff)
+        for title in new:
+            ranked = sorted(tokens(title), key=order.__getitem__)
+            length = len(ranked)
+            prefix = ranked[:length - max(1, ceil(min_overlap * length - 1e-9)) + 1]
+
+            # known titles sharing a prefix token, with compatible length
+            candidates = set()
+            for token in prefix:
+                for other in postings.get(token, ()):
+                    other_length = len(other)
+                    if 2 * min(length, other_length) >= (cutoff - 1e-9) * (length + other_length):
+                        candidates.add(other)
+
+            # score both directions, ratio is not symmetric but its bounds are
+            for other in sorted(candidates):
+                matcher = SequenceMatcher(None, title, other)
+                similarity = cascade(matcher, length, len(other), cutoff, stats)
+                if similarity is None:
+                    continue
+                if similarity >= cutoff:
+                    scores[(title, other)] = similarity
+                reverse = SequenceMatcher(None, other, title).ratio()
+                if stats is not None:
+                    stats["ratio"] = stats.get("ratio", 0) + 1
+                if reverse >= cutoff:
+                    scores[(other, title)] = reverse
+
+            known[title] = prefix
+            for token in prefix:
+                postings.setdefault(token, set()).add(title)
+
+        # titles with a stored score against each title
+        self.partners = {}
+        for title, other in scores:
+            self.partners.setdefault(title, set()).add(other)
+
+        return len(new)
+
+    def candidates(self, norm_titles, titled):
+        """
+        Get candidate pairs for the duplicate search from stored scores
+
+        Args:
+            norm_titles (list): Normalized title of each citation
+            titled (list): Whether each citation has a title
+
+        Returns:
+            dict: Citation index i to ascending list of indices j > i that have
+                the same normalized title or a stored score
+        """
+        by_title = {}
+        for i, title in enumerate(norm_titles):
+            if titled[i]:
+                by_title.setdefault(title, []).append(i)
+
+        candidates = {}
+        for i, title in enumerate(norm_titles):
+            if not titled[i]:
+                continue
+            js = [j for j in by_title[title] if j > i]
+            for other in self.partners.get(title, ()):
+                js.extend(j for j in by_title.get(other, ()) if j > i)
+            candidates[i] = sorted(js)
+
+        return candidates
+
+    def score(self, title1, title2):
+        """Get stored ratio of two different known titles, None if below cutoff"""
+        return self.data["scores"].get((title1, title2))
+
+    def record(self, dois, groups):
+        """
+        Keep DOI map and duplicate groups of this run, for comparison next run
+
+        Args:
+            dois (dict): DOI to titles of citations with it
+            groups (list): Duplicate groups, as lists of citation ids
+
+        Returns:
+            int: Number of groups that differ from last run
+        """
+        previous = {tuple(group) for group in self.data["groups"]}
+        changed = sum(1 for group in groups if tuple(group) not in previous)
+        self.data["dois"] = dois
+        self.data["groups"] = groups
+        return changed
@@ -3,17 +3,23 @@ Module for deduplicating citations with improved detection and logging
 """
 
 import re
+from math import ceil
+from array import array
 from difflib import SequenceMatcher
 from util import log
 from extended_util import citation_completeness_score
+from modules.similarity_store import SimilarityStore
 
-def deduplicate_citations(citations, similarity_threshold=0.9):
+def deduplicate_citations(citations, similarity_threshold=0.9, similarity_store=None, index=None):
     """
     Find and remove duplicate citations with more stringent criteria
     
     Args:
         citations (list): List of citation dictionaries
         similarity_threshold (float): Threshold for title similarity (0.0-1.0)
+        similarity_store (SimilarityStore): Store for title similarity scores of
+            compared pairs, a default store over citations if None
+        index (DedupIndex): Title scores from last run, to only score new titles
         
     Returns:
         tuple: (deduplicated_citations, duplicate_groups, similarity_matrix, group_details)
@@ -22,7 +28,9 @@ def deduplicate_citations(citations, similarity_threshold=0.9):
     citations_copy = [citation.copy() for citation in citations]
     
     # Find duplicate groups
-    duplicate_groups, similarity_matrix = find_duplicates(citations_copy, similarity_threshold)
+    duplicate_groups, similarity_matrix = find_duplicates(
+        citations_copy, similarity_threshold, similarity_store, index
+    )
     
     # If no duplicates found, return original citations
     if not duplicate_groups:
@@ -39,8 +47,13 @@ def normalize_title(title):
         return ""
     return re.sub(r'[^\w\s]', '', title.lower())
 
-def title_similarity(title1, title2):
-    """Calculate similarity between two titles using SequenceMatcher"""
+def title_similarity(title1, title2, cutoff=None, stats=None):
+    """
+    Calculate similarity between two titles using SequenceMatcher
+    
+    If cutoff is given, returns 0 when a cheap upper bound already shows the
+    similarity is below cutoff (see cascade_ratio)
+    """
     if not title1 or not title2:
         return 0
     
@@ -49,9 +62,11 @@ def title_similarity(title1, title2):
     norm_title2 = normalize_title(title2)
     
     # Calculate similarity
-    return SequenceMatcher(None, norm_title1, norm_title2).ratio()
+    matcher = SequenceMatcher(None, norm_title1, norm_title2)
+    similarity = cascade_ratio(matcher, len(norm_title1), len(norm_title2), cutoff or 0, stats)
+    return similarity or 0
 
-def are_identical_titles(title1, title2):
+def are_identical_titles(title1, title2, stats=None):
     """Check if two titles are effectively identical after normalization"""
     norm_title1 = normalize_title(title1)
     norm_title2 = normalize_title(title2)
@@ -61,27 +76,213 @@ def are_identical_titles(title1, title2):
         return True
     
     # Very high similarity (99%+) usually indicates same title with minor punctuation differences
-    similarity = SequenceMatcher(None, norm_title1, norm_title2).ratio()
-    return similarity >= 0.99
+    matcher = SequenceMatcher(None, norm_title1, norm_title2)
+    similarity = cascade_ratio(matcher, len(norm_title1), len(norm_title2), 0.99, stats)
+    return similarity is not None and similarity >= 0.99
+
+def cascade_ratio(matcher, length1, length2, cutoff, stats=None):
+    """
+    Get matcher.ratio(), trying cheaper upper bounds of it first and stopping
+    as soon as one is below cutoff
+    
+    Tiers, cheapest first:
+    1. "length": 2 * min(length) / total length, same as real_quick_ratio
+    2. "quick_ratio": matching characters regardless of order
+    3. "ratio": exact ratio
+    
+    Args:
+        matcher (SequenceMatcher): Matcher with both sequences set
+        length1 (int): Length of first sequence
+        length2 (int): Length of second sequence
+        cutoff (float): Ratio below which the exact value is not needed
+        stats (dict): Counts of pairs pruned per tier (and exactly scored,
+            under "ratio") to add to
+        
+    Returns:
+        float: Exact ratio, or None if below cutoff
+    """
+    total = length1 + length2
+    
+    # same formula as difflib, so bounds compare exactly with ratio
+    if total and 2.0 * min(length1, length2) / total < cutoff:
+        tier = "length"
+        similarity = None
+    elif matcher.quick_ratio() < cutoff:
+        tier = "quick_ratio"
+        similarity = None
+    else:
+        tier = "ratio"
+        similarity = matcher.ratio()
+    
+    if stats is not None:
+        stats[tier] = stats.get(tier, 0) + 1
+    
+    return similarity
+
+class CitationFeatures:
+    """
+    Values the duplicate matchers read, computed once per citation and kept
+    in parallel lists/arrays indexed like the citations list
+    """
+    __slots__ = ("titled", "norm_titles", "lengths", "tokens", "first_authors", "dois", "matchers")
 
-def find_duplicates(citations, similarity_threshold):
+    def __init__(self, citations):
+        """
+        Args:
+            citations (list): List of citation dictionaries
+        """
+        count = len(citations)
+        # whether citation has a (raw) title at all
+        self.titled = array("b", [0]) * count
+        # normalized title, length and character tokens (see title_tokens)
+        self.norm_titles = [""] * count
+        self.lengths = array("L", [0]) * count
+        self.tokens = [()] * count
+        # lower-cased first author, None if no authors
+        self.first_authors = [None] * count
+        # DOI id, None if id is not a DOI
+        self.dois = [None] * count
+        # SequenceMatcher with normalized title as second sequence, made when first needed
+        self.matchers = [None] * count
+
+        for i, citation in enumerate(citations):
+            title = citation.get("title", "")
+            if title:
+                norm_title = normalize_title(title)
+                self.titled[i] = 1
+                self.norm_titles[i] = norm_title
+                self.lengths[i] = len(norm_title)
+                self.tokens[i] = title_tokens(norm_title)
+
+            authors = citation.get("authors", [])
+            if authors:
+                self.first_authors[i] = authors[0].lower().strip()
+
+            _id = citation.get("id")
+            if _id and _id.startswith("doi:"):
+                self.dois[i] = _id
+
+    def matcher(self, j):
+        """
+        Get SequenceMatcher comparing against normalized title j, whose indexing
+        of title j is reused across all comparisons with it
+        """
+        matcher = self.matchers[j]
+        if matcher is None:
+            matcher = self.matchers[j] = SequenceMatcher(None, "", self.norm_titles[j])
+        return matcher
+
+    def title_ratio(self, i, j, cutoff=0, stats=None):
+        """
+        Same as title_similarity of citations i and j, using precomputed values,
+        or None if below cutoff (see cascade_ratio)
+        """
+        matcher = self.matcher(j)
+        matcher.set_seq1(self.norm_titles[i])
+        return cascade_ratio(matcher, self.lengths[i], self.lengths[j], cutoff, stats)
+
+    def first_author_match(self, i, j):
+        """Check if citations i and j have (nearly) the same first author"""
+        first_author_i = self.first_authors[i]
+        first_author_j = self.first_authors[j]
+        if first_author_i is None or first_author_j is None:
+            return False
+        return SequenceMatcher(None, first_author_i, first_author_j).ratio() > 0.9
+
+def title_tokens(norm_title):
+    """
+    Split normalized title into character tokens, numbering repeats of a character
+    (e.g. "aba" -> a1, b1, a2), so two titles share exactly as many tokens as
+    SequenceMatcher.quick_ratio counts matching characters
+    """
+    seen = {}
+    tokens = []
+    for char in norm_title:
+        seen[char] = seen.get(char, 0) + 1
+        tokens.append((char, seen[char]))
+    return tokens
+
+def candidate_pairs(features, threshold):
+    """
+    Find pairs of titles that could reach the similarity threshold, using
+    prefix filtering over character tokens
+
+    SequenceMatcher.ratio never exceeds quick_ratio, which is the Dice
+    coefficient of the titles' character multisets. Pairs with Dice >= t share
+    at least ceil(t * n / (2 - t)) tokens, so if every title's tokens are sorted
+    rarest first, such pairs must share a token within the first
+    n - ceil(t * n / (2 - t)) + 1 tokens of each title. Only titles sharing one of
+    these prefix tokens (and with compatible lengths) are candidates, and no pair
+    that could reach the threshold is ever missed.
+
+    Args:
+        features (CitationFeatures): Precomputed citation values
+        threshold (float): Minimum ratio a pair must be able to reach
+
+    Returns:
+        dict: Citation index i to ascending list of candidate indices j > i
+    """
+    indices = [i for i, titled in enumerate(features.titled) if titled]
+    candidates = {i: set() for i in indices}
+
+    # every pair can reach a non-positive threshold
+    if threshold <= 0:
+        return {i: indices[n + 1:] for n, i in enumerate(indices)}
+
+    # titles that normalize to nothing are identical to each other only
+    empty = [i for i in indices if not features.lengths[i]]
+    for n, i in enumerate(empty):
+        candidates[i].update(empty[n + 1:])
+
+    # order tokens rarest first
+    frequency = {}
+    for i in indices:
+        for token in features.tokens[i]:
+            frequency[token] = frequency.get(token, 0) + 1
+
+    # inverted index of prefix token to (index, title length) seen so far
+    postings = {}
+    min_overlap = threshold / (2 - threshold)
+    for i in indices:
+        length = features.lengths[i]
+        if not length:
+            continue
+        title = sorted(features.tokens[i], key=lambda token: (frequency[token], token))
+        prefix = length - max(1, ceil(min_overlap * length - 1e-9)) + 1
+
+        for token in title[:prefix]:
+            posting = postings.setdefault(token, [])
+            for j, other_length in posting:
+                # length bound, ratio <= 2 * min(len) / (len + len)
+                if 2 * min(length, other_length) >= (threshold - 1e-9) * (length + other_length):
+                    candidates[j].add(i)
+            posting.append((i, length))
+
+    return {i: sorted(js) for i, js in candidates.items()}
+
+def find_duplicates(citations, similarity_threshold, similarity_store=None, index=None):
     """
     Find groups of similar citations based on stricter criteria:
     1. Exact match on DOI (highest priority)
     2. Identical titles after normalization
     3. Very high similarity score + same first author
+    
+    With an index, title scores are looked up instead of computed, and only
+    titles not in the index yet are scored (against their candidate blocks).
+    Groups are the same as without it.
     """
     duplicate_groups = []
-    similarity_matrix = {}  # Store similarity scores for reporting
+    # Store similarity scores for reporting, by default over a snapshot of
+    # citations, as merging duplicates later removes them from the list
+    similarity_matrix = similarity_store if similarity_store is not None else SimilarityStore(list(citations))
     used_indices = set()
     
+    # Compute values the matchers need once per citation
+    features = CitationFeatures(citations)
+    
     # First pass: group by DOI (most reliable identifier)
     doi_groups = {}
-    for i, citation in enumerate(citations):
-        doi = None
-        if citation.get("id") and citation.get("id").startswith("doi:"):
-            doi = citation.get("id")
-        
+    for i, doi in enumerate(features.dois):
         if doi:
             if doi not in doi_groups:
                 doi_groups[doi] = []
@@ -93,67 +294,121 @@ def find_duplicates(citations, similarity_threshold):
             duplicate_groups.append(indices)
             used_indices.update(indices)
     
+    # Only compare titles that can reach the threshold, be identical (99%+)
+    # or be reported
+    cutoff = min(similarity_threshold, 0.99, similarity_matrix.floor)
+    
+    # Count of pairs pruned by each tier of the similarity cascade
+    cascade_stats = {"length": 0, "quick_ratio": 0, "ratio": 0}
+    
+    norm_titles = features.norm_titles
+    
+    # every pair reaches a non-positive cutoff, nothing to skip with an index
+    if index is not None and cutoff > 0:
+        new_titles = index.update(
+            [title for i, title in enumerate(norm_titles) if features.titled[i]],
+            title_tokens, cutoff, cascade_ratio, cascade_stats,
+        )
+        log(f"Scored {new_titles} new title(s) against dedup index", 1)
+        candidates = index.candidates(norm_titles, features.titled)
+        title_ratio = lambda i, j: index.score(norm_titles[i], norm_titles[j])
+    else:
+        index = None
+        candidates = candidate_pairs(features, cutoff)
+        title_ratio = lambda i, j: features.title_ratio(i, j, cutoff, cascade_stats)
+    log(f"Comparing {sum(map(len, candidates.values()))} candidate title pair(s)", 1)
+    
     # Second pass: look for identical titles (after normalization)
     for i in range(len(citations)):
         if i in used_indices:
             continue
             
-        title_i = citations[i].get("title", "")
-        if not title_i:
+        if not features.titled[i]:
             continue
             
         group = [i]
         used_indices.add(i)
         
-        for j in range(i+1, len(citations)):
+        for j in candidates[i]:
             if j in used_indices:
                 continue
-                
-            title_j = citations[j].get("title", "")
-            if not title_j:
-                continue
             
-            # Check if titles are effectively identical
-            if are_identical_titles(title_i, title_j):
+            # Check if titles are effectively identical, exact match after normalization
+            if norm_titles[i] == norm_titles[j]:
                 group.append(j)
                 used_indices.add(j)
                 continue
             
-            # Calculate similarity for reporting
-            similarity = title_similarity(title_i, title_j)
+            # Calculate similarity, skipping pairs that can't reach any cutoff
+            similarity = title_ratio(i, j)
+            if similarity is None:
+                continue
+            
+            # Very high similarity (99%+) usually indicates same title with minor punctuation differences
+            if similarity >= 0.99:
+                group.append(j)
+                used_indices.add(j)
+                continue
             
             # Store similarity for reporting
-            key = f"{i},{j}"
-            similarity_matrix[key] = {
-                "index1": i,
-                "index2": j,
-                "title1": title_i,
-                "title2": title_j,
-                "similarity": similarity
-            }
+            similarity_matrix.add(i, j, similarity)
             
             # Only consider very high similarity titles with same first author
-            if similarity > similarity_threshold:
-                # Check if first authors match
-                authors_i = citations[i].get("authors", [])
-                authors_j = citations[j].get("authors", [])
-                
-                first_author_match = False
-                if authors_i and authors_j:
-                    # Get normalized versions of first authors
-                    first_author_i = authors_i[0].lower().strip() if authors_i else ""
-                    first_author_j = authors_j[0].lower().strip() if authors_j else ""
-                    
-                    # Check for first author match with high threshold
-                    first_author_match = (SequenceMatcher(None, first_author_i, first_author_j).ratio() > 0.9)
-                
-                if first_author_match:
-                    group.append(j)
-                    used_indices.add(j)
+            if similarity > similarity_threshold and features.first_author_match(i, j):
+                group.append(j)
+                used_indices.add(j)
         
         if len(group) > 1:
             duplicate_groups.append(group)
     
+    log(
+        f"Pruned {cascade_stats['length']} pair(s) by length, "
+        f"{cascade_stats['quick_ratio']} by quick ratio, "
+        f"scored {cascade_stats['ratio']} exactly",
+        1,
+    )
+    
+    if index is not None:
+        duplicate_groups, similarity_matrix = check_index(
+            citations, similarity_threshold, similarity_matrix, index, duplicate_groups
+        )
+    
+    return duplicate_groups, similarity_matrix
+
+def check_index(citations, similarity_threshold, similarity_matrix, index, duplicate_groups):
+    """
+    Record groups found with the dedup index, and in verify mode compare them
+    with a search that does not use the index
+    
+    Returns:
+        tuple: (duplicate_groups, similarity_matrix) to use, those of the
+            search without the index if its groups differ
+    """
+    if index.mode == "verify":
+        log("Verifying dedup index against full comparison", 1)
+        store = SimilarityStore(
+            similarity_matrix.citations, floor=similarity_matrix.floor,
+            top_k=similarity_matrix.top_k, spill_after=None,
+        )
+        full_groups, _ = find_duplicates(citations, similarity_threshold, store)
+        if full_groups != duplicate_groups:
+            log("Dedup index gave different groups, rebuilding it next run", 1, "WARNING")
+            index.reset(None)
+            # report scores of the full search, not of the rejected index
+            similarity_matrix.close()
+            return full_groups, store
+        log("Dedup index matches full comparison", 1, "SUCCESS")
+    
+    # DOI map and groups by citation id, to tell what changed since last run
+    dois = {}
+    for citation in citations:
+        _id = citation.get("id", "")
+        if _id.startswith("doi:"):
+            dois.setdefault(_id, []).append(citation.get("title", ""))
+    ids = [[citations[i].get("id", "") for i in group] for group in duplicate_groups]
+    changed = index.record(dois, ids)
+    log(f"{changed} of {len(ids)} duplicate group(s) changed since last run", 1)
+    
     return duplicate_groups, similarity_matrix
 
 def merge_duplicate_groups(citations, duplicate_groups):
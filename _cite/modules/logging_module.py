@@ -1,79 +1,201 @@
 """
-Enhanced logging module to handle both console and file logging
+Logging module that sends every message to the console and the log file
+through a single queue, written by a background thread
 """
 
 import os
+import time
+import queue
+import threading
 from datetime import datetime
+from rich import get_console
 
-# Global log file handle
-log_file = None
+# Message levels, in order of importance. Plain progress messages have no level
+LEVELS = {"INFO": 20, "SUCCESS": 25, "WARNING": 30, "ERROR": 40}
 
-def setup_logging(log_file_path):
+# Console colors by level, or by indent for messages without one
+PALETTE = {
+    0: "[orange1]",
+    1: "[salmon1]",
+    2: "[violet]",
+    3: "[sky_blue1]",
+    "ERROR": "[white on #F43F5E]",
+    "WARNING": "[black on #EAB308]",
+    "SUCCESS": "[black on #10B981]",
+    "INFO": "[grey70]",
+}
+
+# Running sink, once set up
+sink = None
+
+class LogSink:
+    """
+    Queue of log messages, written to the console and a buffered log file by
+    a background thread
+
+    Callers only put messages on the queue. The thread writes everything
+    queued so far in one console write and one file write, and flushes the
+    file at most every flush_interval seconds, or right away for warnings
+    and errors.
+    """
+
+    def __init__(self, log_file_path, console_level="INFO", file_level="INFO", flush_interval=1.0):
+        """
+        Args:
+            log_file_path (str): Path to the log file
+            console_level (str): Min level of messages shown on the console
+            file_level (str): Min level of messages written to the log file
+            flush_interval (float): Max seconds between log file flushes
+        """
+        self.console = get_console()
+        self.console_level = LEVELS[console_level]
+        self.file_level = LEVELS[file_level]
+        self.flush_interval = flush_interval
+        self.queue = queue.SimpleQueue()
+
+        # Create directory for log file if it doesn't exist
+        log_dir = os.path.dirname(log_file_path)
+        if log_dir and not os.path.exists(log_dir):
+            os.makedirs(log_dir, exist_ok=True)
+
+        # Open log file for writing, buffered, console still works without it
+        try:
+            self.file = open(log_file_path, "w", encoding="utf-8", buffering=2**16)
+            # Write header to log file
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.file.write(f"Citation Processing Log - Started at {timestamp}\n")
+            self.file.write("=" * 80 + "\n")
+        except Exception as e:
+            self.console.print(f"Error setting up log file: {e}")
+            self.file = None
+
+        self.thread = threading.Thread(target=self.run, name="log-sink", daemon=True)
+        self.thread.start()
+
+    def put(self, message, indent=0, level="", newline=True):
+        """Queue a message, see util.log"""
+        self.queue.put((str(message), indent, level, newline))
+
+    def run(self):
+        """Write queued messages until closed"""
+        last_flush = 0.0
+        closed = False
+        while not closed:
+            # Wait for a message, but wake up to flush now and then
+            try:
+                records = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                records = []
+            # Take everything else queued meanwhile, to write it at once
+            while True:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in records:
+                closed = True
+                records = records[:records.index(None)]
+
+            try:
+                urgent = self.write(records)
+            except Exception as e:
+                urgent = False
+                self.console.print(f"Error writing log: {e}", markup=False)
+
+            now = time.monotonic()
+            if self.file and (urgent or closed or now - last_flush >= self.flush_interval):
+                self.file.flush()
+                last_flush = now
+
+    def write(self, records):
+        """
+        Write a batch of messages to each handler they pass the level filter of
+
+        Returns:
+            bool: Whether the batch has a warning or error
+        """
+        console = []
+        plain = []
+        lines = []
+        urgent = False
+        for message, indent, level, newline in records:
+            rank = LEVELS.get(level, LEVELS["INFO"])
+            urgent = urgent or rank >= LEVELS["WARNING"]
+            prefix = indent * "    "
+            if rank >= self.console_level:
+                color = PALETTE.get(level) or PALETTE.get(indent) or "[white]"
+                console.append(("\n" if newline else "") + prefix + color + message + "[/]")
+                plain.append(("\n" if newline else "") + prefix + message)
+            if self.file and rank >= self.file_level:
+                level_prefix = f"[{level}] " if level else ""
+                lines.append(("\n" if newline else "") + prefix + level_prefix + message)
+
+        if console:
+            try:
+                self.console.print("".join(console), end="")
+            except Exception:
+                # a message with broken markup, show that batch without colors
+                self.console.print("".join(plain), end="", markup=False)
+            self.console.file.flush()
+        if lines:
+            try:
+                self.file.write("".join(lines))
+            except Exception as e:
+                self.console.print(f"Error writing to log file: {e}")
+
+        return urgent and bool(lines)
+
+    def close(self):
+        """Write out queued messages, then close the log file"""
+        self.queue.put(None)
+        self.thread.join()
+        if self.file:
+            # Write footer to log file
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.file.write(f"\n\nProcessing completed at {timestamp}\n")
+            self.file.write("=" * 80 + "\n")
+            self.file.close()
+
+def setup_logging(log_file_path, console_level="INFO", file_level="INFO", flush_interval=1.0):
     """
     Set up the logging system with both console and file output
-    
+
     Args:
         log_file_path (str): Path to the log file
+        console_level (str): Min level of messages shown on the console
+        file_level (str): Min level of messages written to the log file
+        flush_interval (float): Max seconds between log file flushes
+
+    Returns:
+        bool: Whether the log file could be opened
     """
-    global log_file
-    
-    # Create directory for log file if it doesn't exist
-    log_dir = os.path.dirname(log_file_path)
-    if log_dir and not os.path.exists(log_dir):
-        os.makedirs(log_dir, exist_ok=True)
-    
-    # Open log file for writing
-    try:
-        log_file = open(log_file_path, "w", encoding="utf-8")
-        # Write header to log file
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_file.write(f"Citation Processing Log - Started at {timestamp}\n")
-        log_file.write("=" * 80 + "\n\n")
-        log_file.flush()
-        return True
-    except Exception as e:
-        print(f"Error setting up log file: {e}")
-        return False
+    global sink
+    close_logging()
+    sink = LogSink(log_file_path, console_level, file_level, flush_interval)
+    return sink.file is not None
 
 def close_logging():
-    """Close the log file if it's open"""
-    global log_file
-    if log_file:
-        # Write footer to log file
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_file.write(f"\n\nProcessing completed at {timestamp}\n")
-        log_file.write("=" * 80 + "\n")
-        log_file.close()
-        log_file = None
-
-def log_to_file(message="", indent=0, level="", newline=True):
+    """Write out queued messages and close the log file, if logging is set up"""
+    global sink
+    if sink:
+        sink.close()
+        sink = None
+
+def log_message(message, indent=0, level="", newline=True):
     """
-    Log to file and console with appropriate formatting
-    
+    Log to console and log file, or only to console (right away) if logging
+    isn't set up, e.g. when a module is used on its own
+
     Args:
         message (str): Message to log
         indent (int): Indentation level
-        level (str): Log level (ERROR, WARNING, SUCCESS, INFO)
-        newline (bool): Whether to add a newline at the end
+        level (str): Log level (ERROR, WARNING, SUCCESS, INFO), none for progress
+        newline (bool): Whether to start a new line before the message
     """
-    global log_file
-    
-    # Format message with indentation
-    indent_str = indent * "    "
-    level_prefix = f"[{level}] " if level else ""
-    message_str = f"{indent_str}{level_prefix}{message}"
-    
-    # Always log to console (original logging functionality)
-    # This is assuming the original log function is available in the calling context
-    # If not, we can duplicate that functionality here
-    
-    # Log to file if file is open
-    if log_file:
-        try:
-            if newline:
-                log_file.write(message_str + "\n")
-            else:
-                log_file.write(message_str)
-            log_file.flush()
-        except Exception as e:
-            print(f"Error writing to log file: {e}")
\ No newline at end of file
+    if sink:
+        sink.put(message, indent, level, newline)
+        return
+    color = PALETTE.get(level) or PALETTE.get(indent) or "[white]"
+    console = get_console()
+    console.print(("\n" if newline else "") + indent * "    " + color + str(message) + "[/]", end="")
+    console.file.flush()
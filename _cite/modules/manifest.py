@@ -0,0 +1,167 @@
+"""
+Module for the incremental run manifest, recording content hashes of data
+files, plugin entries and sources along with the results they produced
+"""
+
+import os
+import json
+import time
+import pickle
+import hashlib
+from pathlib import Path
+
+# bump when the layout of stored results changes, to discard old manifests
+VERSION = 1
+
+def content_hash(value):
+    """
+    Get stable hash of YAML/JSON-like data, or of raw bytes
+
+    Args:
+        value: Dict/list/scalar data, or bytes
+
+    Returns:
+        str: Hex digest
+    """
+    if not isinstance(value, bytes):
+        value = json.dumps(value, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(value).hexdigest()
+
+class Manifest:
+    """
+    Results of the last run keyed by content hash, so unchanged data file
+    entries and sources can be spliced back in instead of reprocessed
+
+    Stored with pickle, so loaded YAML values (e.g. dates) keep their types
+
+    Sections:
+        files: data file path to {"hash", "entries": entry keys}
+        entries: entry key to {"entry", "sources", "time"}
+        citations: source key to {"citation", "time"}
+    """
+
+    def __init__(self, path, ttl=None, enabled=True):
+        """
+        Args:
+            path (str): Manifest file to load from and save to
+            ttl (dict): Max age in seconds of stored results, keyed by plugin
+                name, with "default" used for unlisted plugins, None for no limit
+            enabled (bool): Whether to reuse stored results, if False results
+                are only recorded (full run)
+        """
+        self.path = Path(path)
+        self.ttl = ttl or {}
+        self.enabled = enabled
+        self.data = {"version": VERSION, "files": {}, "entries": {}, "citations": {}}
+        # keys used this run, everything else is dropped on save
+        self.used = {"files": set(), "entries": set(), "citations": set()}
+        # counts of reused and reprocessed results, per section
+        self.stats = {"reused": {}, "processed": {}}
+
+        if enabled:
+            self.load()
+
+    def load(self):
+        """Load manifest from disk, starting empty if missing, invalid or outdated"""
+        try:
+            with open(self.path, "rb") as file:
+                data = pickle.load(file)
+            if data.get("version") == VERSION:
+                self.data = data
+        except Exception:
+            pass
+
+    def save(self):
+        """Write manifest to disk atomically, keeping only keys used this run"""
+        for section, keys in self.used.items():
+            self.data[section] = {
+                key: value for key, value in self.data[section].items() if key in keys
+            }
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp = self.path.with_name(self.path.name + ".tmp")
+        with open(temp, "wb") as file:
+            pickle.dump(self.data, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, self.path)
+
+    def fresh(self, record, plugin):
+        """Check if stored record is younger than the TTL of its plugin"""
+        ttl = self.ttl.get(Path(plugin).stem, self.ttl.get("default"))
+        return ttl is None or time.time() - record.get("time", 0) < ttl
+
+    def get(self, section, key, plugin=""):
+        """
+        Get stored record, if reuse is enabled and it is still fresh
+
+        Args:
+            section (str): "entries" or "citations"
+            key (str): Content hash key
+            plugin (str): Plugin name or file, for TTL lookup
+
+        Returns:
+            dict: Stored record, or None
+        """
+        self.used[section].add(key)
+        record = self.data[section].get(key)
+        if not self.enabled or record is None or not self.fresh(record, plugin):
+            return None
+        self.stats["reused"][section] = self.stats["reused"].get(section, 0) + 1
+        return record
+
+    def set(self, section, key, record):
+        """
+        Store record for key, stamped with the current time
+
+        Args:
+            section (str): "entries" or "citations"
+            key (str): Content hash key
+            record (dict): Result to store
+        """
+        self.used[section].add(key)
+        self.data[section][key] = {**record, "time": time.time()}
+        self.stats["processed"][section] = self.stats["processed"].get(section, 0) + 1
+
+    def get_file(self, path, file_hash):
+        """
+        Get entries of a data file from last run, if its content is unchanged
+        and reuse is enabled
+
+        Args:
+            path (str): Data file path
+            file_hash (str): Content hash of data file
+
+        Returns:
+            list: Data file entries, or None
+        """
+        key = str(path)
+        self.used["files"].add(key)
+        record = self.data["files"].get(key)
+        if not self.enabled or not record or record["hash"] != file_hash:
+            return None
+        # entries are only kept while some run still uses them
+        if not all(entry in self.data["entries"] for entry in record["entries"]):
+            return None
+        self.stats["reused"]["files"] = self.stats["reused"].get("files", 0) + 1
+        return [self.data["entries"][entry]["entry"] for entry in record["entries"]]
+
+    def set_file(self, path, file_hash, entry_keys):
+        """
+        Store content hash and entry keys of a data file
+
+        Args:
+            path (str): Data file path
+            file_hash (str): Content hash of data file
+            entry_keys (list): Manifest keys of the file's entries, in order
+        """
+        key = str(path)
+        self.used["files"].add(key)
+        self.data["files"][key] = {"hash": file_hash, "entries": entry_keys}
+        self.stats["processed"]["files"] = self.stats["processed"].get("files", 0) + 1
+
+def entry_key(plugin, entry):
+    """Get manifest key of a plugin data file entry"""
+    return content_hash([plugin, entry])
+
+def source_key(source):
+    """Get manifest key of a compiled source"""
+    return content_hash(source)
@@ -6,11 +6,10 @@ import os
 import json
 from datetime import datetime
 from util import log
-from modules.logging_module import log_to_file
 from extended_util import citation_completeness_score, format_authors_for_display
 
 def generate_reports(report_dir, all_sources, all_citations, duplicate_groups, 
-                    similarity_matrix, group_details):
+                    similarity_matrix, group_details, failures=None, run_summary=None, network=None):
     """
     Generate HTML report and log files for citation processing
     
@@ -19,34 +18,38 @@ def generate_reports(report_dir, all_sources, all_citations, duplicate_groups,
         all_sources (list): All source entries
         all_citations (list): All citation entries
         duplicate_groups (list): Groups of duplicate citation indices
-        similarity_matrix (dict): Matrix of similarity scores
+        similarity_matrix (SimilarityStore): Similarity scores of compared title pairs
         group_details (list): Details about how duplicates were handled
+        failures (list): Failed lookups of this run, fresh or skipped as recently failed
+        run_summary (dict): Time and memory of stages and plugins so far (see RunStats.summary)
+        network (dict): Request latencies per host and slowest ids (see http_trace.summary)
     """
+    failures = failures or []
+    
     # Create HTML report
     html_report_file = os.path.join(report_dir, "citation_report.html")
     html_report = generate_html_report(all_sources, all_citations, duplicate_groups, 
-                                      similarity_matrix, group_details)
+                                      similarity_matrix, group_details, failures, run_summary, network)
     
     # Save HTML report
     with open(html_report_file, "w", encoding="utf-8") as f:
         f.write(html_report)
     
     log(f"HTML report saved to {html_report_file}", 1)
-    log_to_file(f"HTML report saved to {html_report_file}", 1)
     
     # Create a detailed text report for quick review
     text_report_file = os.path.join(report_dir, "deduplication_summary.txt")
-    text_report = generate_text_report(all_citations, duplicate_groups, group_details)
+    text_report = generate_text_report(all_citations, duplicate_groups, group_details, failures)
     
     # Save text report
     with open(text_report_file, "w", encoding="utf-8") as f:
         f.write(text_report)
     
     log(f"Text summary saved to {text_report_file}", 1)
-    log_to_file(f"Text summary saved to {text_report_file}", 1)
 
-def generate_text_report(all_citations, duplicate_groups, group_details):
+def generate_text_report(all_citations, duplicate_groups, group_details, failures=None):
     """Generate a plain text report of deduplication results for quick review"""
+    failures = failures or []
     
     # Identify Google Scholar-only entries
     google_scholar_only = []
@@ -69,7 +72,21 @@ def generate_text_report(all_citations, duplicate_groups, group_details):
     report += f"Duplicate groups found: {len(duplicate_groups)}\n"
     report += f"Citations removed: {sum(len(group) - 1 for group in duplicate_groups)}\n"
     report += f"Final citation count: {len(all_citations) - sum(len(group) - 1 for group in duplicate_groups)}\n"
-    report += f"Google Scholar only entries: {len(google_scholar_only)}\n\n"
+    report += f"Google Scholar only entries: {len(google_scholar_only)}\n"
+    report += f"Failed lookups: {len(failures)}\n\n"
+    
+    # List failed lookups, each skipped until it expires or is retried with --retry ID
+    if failures:
+        report += "FAILED LOOKUPS\n"
+        report += "-" * 30 + "\n\n"
+        
+        for failure in failures:
+            status = "skipped, failed recently" if failure['cached'] else "failed"
+            report += f"  {failure['id']} ({failure['namespace']}): {failure['reason']}, {status}\n"
+            report += f"    {failure['message']}\n"
+            report += f"    since {failure['time']}\n\n"
+        
+        report += "-" * 30 + "\n\n"
     
     if not group_details:
         report += "No duplicates were found and removed.\n"
@@ -136,7 +153,7 @@ def generate_text_report(all_citations, duplicate_groups, group_details):
     return report
 
 def generate_html_report(all_sources, all_citations, duplicate_groups, 
-                        similarity_matrix, group_details):
+                        similarity_matrix, group_details, failures=None, run_summary=None, network=None):
     """
     Generate HTML report content
     
@@ -144,12 +161,19 @@ def generate_html_report(all_sources, all_citations, duplicate_groups,
         all_sources (list): All source entries
         all_citations (list): All citation entries
         duplicate_groups (list): Groups of duplicate citation indices
-        similarity_matrix (dict): Matrix of similarity scores
+        similarity_matrix (SimilarityStore): Similarity scores of compared title pairs
         group_details (list): Details about how duplicates were handled
+        failures (list): Failed lookups of this run
+        run_summary (dict): Time and memory of stages and plugins so far
+        network (dict): Request latencies per host and slowest ids
     
     Returns:
         str: HTML report content
     """
+    failures = failures or []
+    run_summary = run_summary or {"stages": {}, "plugins": {}}
+    network = network or {"hosts": {}, "slowest": []}
+    
     # Identify Google Scholar-only entries
     google_scholar_only = []
     gs_ids = set()
@@ -314,6 +338,9 @@ def generate_html_report(all_sources, all_citations, duplicate_groups,
             <a href="#citations">All Citations</a>
             <a href="#duplicates">Duplicate Groups</a>
             <a href="#google-scholar">Google Scholar Only</a>
+            <a href="#failures">Failed Lookups</a>
+            <a href="#timing">Timing</a>
+            <a href="#network">Network</a>
         </div>
         
         <div class="section stats" id="summary">
@@ -323,6 +350,7 @@ def generate_html_report(all_sources, all_citations, duplicate_groups,
             <p><strong>Duplicate Groups Found:</strong> """ + str(len(duplicate_groups)) + """</p>
             <p><strong>Citations After Deduplication:</strong> """ + str(len(all_citations) - sum(len(group) - 1 for group in duplicate_groups)) + """</p>
             <p><strong>Google Scholar Only Entries:</strong> """ + str(len(google_scholar_only)) + """</p>
+            <p><strong>Failed Lookups:</strong> """ + str(len(failures)) + """</p>
         </div>
         
         <div class="section" id="sources">
@@ -484,7 +512,7 @@ def generate_html_report(all_sources, all_citations, duplicate_groups,
         
         <div class="section" id="similarity">
             <h2>Similarity Matrix</h2>
-            <p>Showing pairs with similarity > 0.7</p>
+            <p>Showing pairs with similarity >= """ + str(similarity_matrix.floor) + """, at most """ + str(similarity_matrix.top_k) + """ per citation</p>
             
             <div class="filter-box">
                 <input type="text" id="similarityFilter" onkeyup="filterTable('similarityFilter', 'similarityTable')" placeholder="Filter similarity matrix...">
@@ -500,6 +528,37 @@ def generate_html_report(all_sources, all_citations, duplicate_groups,
                 </tr>
     """
     
+    # Add similar title pairs
+    for pair in similarity_matrix:
+        similarity = pair['similarity']
+        row_class = "similarity-high" if similarity >= 0.9 else "similarity-medium"
+        html += f"""
+                <tr class="{row_class}">
+                    <td>{pair['index1']}</td>
+                    <td>{pair['index2']}</td>
+                    <td>{pair['title1']}</td>
+                    <td>{pair['title2']}</td>
+                    <td>{similarity:.3f}</td>
+                </tr>
+        """
+    
+    html += """
+            </table>
+        </div>
+        
+        <div class="section" id="google-scholar">
+            <h2>Google Scholar Only Entries</h2>
+            
+            <table>
+                <tr>
+                    <th>Title</th>
+                    <th>Authors</th>
+                    <th>Publisher</th>
+                    <th>Date</th>
+                    <th>ID</th>
+                    <th>Link</th>
+                </tr>
+    """
     
     # Add Google Scholar-only entries
     if google_scholar_only:
@@ -528,6 +587,206 @@ def generate_html_report(all_sources, all_citations, duplicate_groups,
                 </tr>
         """
     
+    html += """
+            </table>
+        </div>
+        
+        <div class="section" id="failures">
+            <h2>Failed Lookups</h2>
+            <p>Failed ids are skipped until their failure expires, run with --retry ID to look one up again now</p>
+            
+            <table>
+                <tr>
+                    <th>ID</th>
+                    <th>Lookup</th>
+                    <th>Reason</th>
+                    <th>Message</th>
+                    <th>Failed Since</th>
+                    <th>This Run</th>
+                </tr>
+    """
+    
+    # Add failed lookups
+    if failures:
+        for failure in failures:
+            status = "Skipped" if failure['cached'] else "Failed"
+            html += f"""
+                <tr>
+                    <td>{failure['id']}</td>
+                    <td>{failure['namespace']}</td>
+                    <td>{failure['reason']}</td>
+                    <td>{failure['message']}</td>
+                    <td>{failure['time']}</td>
+                    <td>{status}</td>
+                </tr>
+            """
+    else:
+        html += """
+                <tr>
+                    <td colspan="6">No failed lookups.</td>
+                </tr>
+        """
+    
+    html += """
+            </table>
+        </div>
+        
+        <div class="section" id="timing">
+            <h2>Timing</h2>
+            <p>Stages after deduplication finish once this report is written, see run_summary.json for the whole run</p>
+            
+            <table>
+                <tr>
+                    <th>Stage</th>
+                    <th>Wall (s)</th>
+                    <th>CPU (s)</th>
+                    <th>Peak RSS (MB)</th>
+                    <th>RSS Growth (MB)</th>
+                    <th>Allocated (MB)</th>
+                    <th>Peak Allocated (MB)</th>
+                </tr>
+    """
+    
+    # Add stage timings
+    for stage, values in run_summary["stages"].items():
+        html += f"""
+                <tr>
+                    <td>{stage}</td>
+                    <td>{values['wall_seconds']}</td>
+                    <td>{values['cpu_seconds']}</td>
+                    <td>{values.get('peak_rss_mb', '')}</td>
+                    <td>{values.get('rss_growth_mb', '')}</td>
+                    <td>{values.get('allocated_mb', '')}</td>
+                    <td>{values.get('peak_allocated_mb', '')}</td>
+                </tr>
+        """
+    
+    html += """
+            </table>
+    """
+    
+    # Explain empty allocation columns of untraced stages
+    if any("allocated_mb" not in values for values in run_summary["stages"].values()):
+        html += """
+            <p>Allocated is only measured for stages run while tracing Python allocations, which slows them several times over. By default that is only the sources stage, set trace_memory to "all" in cite.py to trace every stage</p>
+        """
+    
+    html += """
+            
+            <h3>Plugins</h3>
+            <p>Entries run concurrently, so time is summed over entries. Held is memory still allocated by plugin code after all sources are compiled</p>
+            
+            <table>
+                <tr>
+                    <th>Plugin</th>
+                    <th>Entries</th>
+                    <th>Wall (s)</th>
+                    <th>CPU (s)</th>
+                    <th>Held (MB)</th>
+                </tr>
+    """
+    
+    # Add plugin timings
+    if run_summary["plugins"]:
+        for plugin, values in run_summary["plugins"].items():
+            html += f"""
+                <tr>
+                    <td>{plugin}</td>
+                    <td>{values['entries']}</td>
+                    <td>{values['wall_seconds']}</td>
+                    <td>{values['cpu_seconds']}</td>
+                    <td>{values.get('allocated_mb', '')}</td>
+                </tr>
+            """
+    else:
+        html += """
+                <tr>
+                    <td colspan="5">No plugins ran.</td>
+                </tr>
+        """
+    
+    html += """
+            </table>
+        </div>
+        
+        <div class="section" id="network">
+            <h2>Network</h2>
+            <p>Latency of requests made, in ms. Cache hits made no request, every request is listed in network_trace.jsonl</p>
+            
+            <table>
+                <tr>
+                    <th>Host</th>
+                    <th>Requests</th>
+                    <th>Cache Hits</th>
+                    <th>p50</th>
+                    <th>p90</th>
+                    <th>p99</th>
+                    <th>Max</th>
+                    <th>Total (s)</th>
+                    <th>KB</th>
+                    <th>Retries</th>
+                    <th>Errors</th>
+                </tr>
+    """
+    
+    # Add hosts, slowest in total first
+    if network["hosts"]:
+        ms = lambda seconds: "" if seconds is None else f"{seconds * 1000:.0f}"
+        for host, values in sorted(network["hosts"].items(), key=lambda item: -item[1]["total_seconds"]):
+            html += f"""
+                <tr>
+                    <td>{host}</td>
+                    <td>{values['requests']}</td>
+                    <td>{values['cache'].get('hit', 0)}</td>
+                    <td>{ms(values['p50'])}</td>
+                    <td>{ms(values['p90'])}</td>
+                    <td>{ms(values['p99'])}</td>
+                    <td>{ms(values['max'])}</td>
+                    <td>{values['total_seconds']}</td>
+                    <td>{values['bytes'] / 2**10:.0f}</td>
+                    <td>{values['retries']}</td>
+                    <td>{values['errors']}</td>
+                </tr>
+            """
+    else:
+        html += """
+                <tr>
+                    <td colspan="11">No requests made.</td>
+                </tr>
+        """
+    
+    html += """
+            </table>
+            
+            <h3>Slowest IDs</h3>
+            
+            <table>
+                <tr>
+                    <th>ID</th>
+                    <th>Requests</th>
+                    <th>Total (s)</th>
+                    <th>Hosts</th>
+                </tr>
+    """
+    
+    # Add ids whose requests took longest
+    if network["slowest"]:
+        for item in network["slowest"]:
+            html += f"""
+                <tr>
+                    <td>{item['subject']}</td>
+                    <td>{item['requests']}</td>
+                    <td>{item['seconds']}</td>
+                    <td>{", ".join(item['hosts'])}</td>
+                </tr>
+            """
+    else:
+        html += """
+                <tr>
+                    <td colspan="4">No requests made for an id.</td>
+                </tr>
+        """
+    
     html += """
             </table>
         </div>
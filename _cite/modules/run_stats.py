@@ -0,0 +1,222 @@
+"""
+Module for measuring the time and memory each stage and plugin of a run takes
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from importlib import import_module
+from util import log
+
+# resource is only available on Unix, peak RSS is left out elsewhere
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def peak_rss_mb():
+    """Get the highest resident set size of the process so far, in MB, or None if unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+class RunStats:
+    """
+    Wall time, CPU time, peak RSS and Python allocations of each stage of a
+    run, and of each plugin
+
+    Stages run one after another, so each gets its own numbers. Plugin entries
+    run concurrently on worker threads, so plugins get the wall and CPU time
+    of their own threads, and the memory still held at the end of the sources
+    stage by allocations made from their code. Tracing allocations slows
+    allocation-heavy code (e.g. deduplication) several times over, so by
+    default it stops once plugin memory is measured, and later stages only get
+    peak RSS. With trace_memory "all", later stages are traced too, cheaper
+    without stacks but still slower.
+
+    Peak RSS is a high-water mark of the whole process, so a stage's peak is
+    the highest RSS up to its end, and growth is how far the stage raised it.
+    """
+
+    def __init__(self, trace_memory=True, frames=10):
+        """
+        Args:
+            trace_memory (bool or str): Whether to trace Python allocations
+                with tracemalloc until plugin memory is measured, or "all" to
+                trace every stage
+            frames (int): Stack frames kept per allocation until plugin memory
+                is measured, enough to reach plugin code from the libraries it calls
+        """
+        self.trace_memory = trace_memory
+        self.frames = frames
+        self.started = time.perf_counter()
+        self.started_at = datetime.now().isoformat(timespec="seconds")
+        self.stages = {}
+        self.plugins = {}
+        self.lock = threading.Lock()
+
+        # only trace if nothing else is, e.g. python -X tracemalloc
+        self.tracing = trace_memory and not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start(frames)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Measure a stage of the run
+
+        Args:
+            name (str): Stage name
+        """
+        rss_before = peak_rss_mb()
+        if tracemalloc.is_tracing():
+            allocated_before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            stats = {
+                "wall_seconds": round(time.perf_counter() - wall, 3),
+                "cpu_seconds": round(time.process_time() - cpu, 3),
+            }
+            rss = peak_rss_mb()
+            if rss is not None:
+                stats["peak_rss_mb"] = round(rss, 1)
+                stats["rss_growth_mb"] = round(rss - rss_before, 1)
+            if tracemalloc.is_tracing():
+                allocated, peak = tracemalloc.get_traced_memory()
+                stats["allocated_mb"] = round((allocated - allocated_before) / 2**20, 2) or 0.0
+                stats["peak_allocated_mb"] = round((peak - allocated_before) / 2**20, 2)
+            self.stages[name] = stats
+
+    def add_plugin_call(self, plugin, wall, cpu, prefetch=False):
+        """
+        Add the time of one plugin call, safe to call from worker threads
+
+        Args:
+            plugin (str): Plugin name
+            wall (float): Wall time of the call in seconds
+            cpu (float): CPU time of the calling thread in seconds
+            prefetch (bool): Whether the call was the prefetch hook rather than an entry
+        """
+        with self.lock:
+            stats = self.plugins.setdefault(
+                plugin, {"entries": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0}
+            )
+            if not prefetch:
+                stats["entries"] += 1
+            stats["wall_seconds"] += wall
+            stats["cpu_seconds"] += cpu
+
+    @contextmanager
+    def plugin_call(self, plugin, prefetch=False):
+        """
+        Measure a plugin call made on the current thread
+
+        Args:
+            plugin (str): Plugin name
+            prefetch (bool): Whether the call is the prefetch hook rather than an entry
+        """
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            self.add_plugin_call(
+                plugin, time.perf_counter() - wall, time.thread_time() - cpu, prefetch
+            )
+
+    def measure_plugin_memory(self, plugins):
+        """
+        Find the memory held by allocations made from each plugin's code,
+        e.g. its sources and parsed responses, from a tracemalloc snapshot
+
+        Args:
+            plugins (list): Plugin names
+        """
+        if not tracemalloc.is_tracing():
+            return
+        paths = {}
+        for plugin in plugins:
+            try:
+                paths[import_module(f"plugins.{plugin}").__file__] = plugin
+            except Exception:
+                continue
+
+        snapshot = tracemalloc.take_snapshot()
+
+        # later stages need no stacks, trace them (and the grouping below)
+        # cheaply, or not at all unless asked to, as it slows them down
+        if self.tracing and self.trace_memory == "all":
+            tracemalloc.stop()
+            tracemalloc.start(1)
+        else:
+            self.close()
+
+        # size of traces with each file anywhere on their stack
+        sizes = dict.fromkeys(paths.values(), 0)
+        for stat in snapshot.statistics("filename", cumulative=True):
+            plugin = paths.get(stat.traceback[0].filename)
+            if plugin:
+                sizes[plugin] = stat.size
+
+        for plugin, size in sizes.items():
+            stats = self.plugins.setdefault(
+                plugin, {"entries": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0}
+            )
+            stats["allocated_mb"] = round(size / 2**20, 2)
+
+    def summary(self):
+        """
+        Get run summary
+
+        Returns:
+            dict: Start time, totals, and stats of each stage and plugin
+        """
+        plugins = {
+            plugin: {
+                **stats,
+                "wall_seconds": round(stats["wall_seconds"], 3),
+                "cpu_seconds": round(stats["cpu_seconds"], 3),
+            }
+            for plugin, stats in self.plugins.items()
+        }
+        rss = peak_rss_mb()
+        return {
+            "started": self.started_at,
+            "wall_seconds": round(time.perf_counter() - self.started, 3),
+            "cpu_seconds": round(time.process_time(), 3),
+            "peak_rss_mb": round(rss, 1) if rss is not None else None,
+            "traced_memory": self.trace_memory,
+            "stages": self.stages,
+            "plugins": plugins,
+        }
+
+    def save(self, path):
+        """
+        Write run summary as JSON
+
+        Args:
+            path (str): File to write to
+        """
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(self.summary(), file, indent=2)
+        except Exception as e:
+            log(f"Couldn't save run summary: {e}", 1, "WARNING")
+
+    def close(self):
+        """Stop tracing allocations, if this started it"""
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
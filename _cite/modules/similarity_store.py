@@ -0,0 +1,153 @@
+"""
+Module for keeping title similarity scores for reporting, bounded in size
+"""
+
+import os
+import heapq
+import sqlite3
+import tempfile
+
+class SimilarityStore:
+    """
+    Sparse store of title similarity scores between pairs of citations
+
+    Only pairs scoring at or above the reporting floor are kept, and only the
+    top_k best scoring pairs of each citation. Pairs reference citations by
+    index, titles are looked up in the citations list when reading. Once more
+    than spill_after pairs are held, they are moved to a temporary SQLite
+    database on disk.
+    """
+
+    def __init__(self, citations, floor=0.9, top_k=5, spill_after=200000, spill_dir=None):
+        """
+        Args:
+            citations (list): Citations that pair indices refer to
+            floor (float): Minimum similarity of a pair to keep it
+            top_k (int): Max pairs kept per citation, None for no limit
+            spill_after (int): Max pairs held in memory before moving to disk, None to never spill
+            spill_dir (str): Directory for the spill database, system temp dir if None
+        """
+        self.citations = citations
+        self.floor = floor
+        self.top_k = top_k
+        self.spill_after = spill_after
+        self.spill_dir = spill_dir
+
+        # best pairs of each citation, as min-heaps of (similarity, other index)
+        self.heaps = {}
+        self.size = 0
+
+        # spill database, once spilled
+        self.db = None
+        self.db_path = None
+
+    def add(self, index1, index2, similarity):
+        """
+        Record similarity of a pair of citations, if it makes the floor
+
+        Args:
+            index1 (int): Index of first citation
+            index2 (int): Index of second citation
+            similarity (float): Similarity of titles (0.0-1.0)
+        """
+        if similarity < self.floor:
+            return
+
+        if self.db:
+            self.db.execute("INSERT INTO pairs VALUES (?, ?, ?)", (index1, index2, similarity))
+            return
+
+        self.push(index1, index2, similarity)
+        self.push(index2, index1, similarity)
+
+        if self.spill_after is not None and self.size > self.spill_after:
+            self.spill()
+
+    def push(self, index, other, similarity):
+        """Add pair to heap of one citation, dropping its worst pair past top_k"""
+        heap = self.heaps.setdefault(index, [])
+        if self.top_k is None or len(heap) < self.top_k:
+            heapq.heappush(heap, (similarity, other))
+            self.size += 1
+        elif (similarity, other) > heap[0]:
+            heapq.heapreplace(heap, (similarity, other))
+
+    def spill(self):
+        """Move all pairs to a temporary SQLite database and keep adding them there"""
+        pairs = self.pairs()
+        handle, self.db_path = tempfile.mkstemp(prefix="similarity-", suffix=".db", dir=self.spill_dir)
+        os.close(handle)
+        self.db = sqlite3.connect(self.db_path)
+        self.db.execute("CREATE TABLE pairs (index1 INTEGER, index2 INTEGER, similarity REAL)")
+        self.db.executemany("INSERT INTO pairs VALUES (?, ?, ?)", pairs)
+        self.heaps = {}
+        self.size = 0
+
+    def pairs(self):
+        """
+        Get kept pairs, best first
+
+        Returns:
+            list: (index1, index2, similarity) tuples, index1 < index2
+        """
+        if self.db:
+            return self.db_pairs()
+
+        pairs = {}
+        for index, heap in self.heaps.items():
+            for similarity, other in heap:
+                pairs[(min(index, other), max(index, other))] = similarity
+
+        return sorted(
+            ((index1, index2, similarity) for (index1, index2), similarity in pairs.items()),
+            key=lambda pair: (-pair[2], pair[0], pair[1]),
+        )
+
+    def db_pairs(self):
+        """Get top_k pairs of each citation from the spill database, best first"""
+        if self.top_k is None:
+            query = "SELECT index1, index2, similarity FROM pairs"
+        else:
+            # rank pairs from the side of both citations, keep if in top_k of either
+            query = f"""
+                WITH sides AS (
+                    SELECT index1 AS citation, index2 AS other, index1, index2, similarity FROM pairs
+                    UNION ALL
+                    SELECT index2 AS citation, index1 AS other, index1, index2, similarity FROM pairs
+                ),
+                ranked AS (
+                    SELECT index1, index2, similarity, ROW_NUMBER() OVER (
+                        PARTITION BY citation ORDER BY similarity DESC, other DESC
+                    ) AS rank FROM sides
+                )
+                SELECT DISTINCT index1, index2, similarity FROM ranked WHERE rank <= {int(self.top_k)}
+            """
+        pairs = [(min(a, b), max(a, b), similarity) for a, b, similarity in self.db.execute(query)]
+        return sorted(set(pairs), key=lambda pair: (-pair[2], pair[0], pair[1]))
+
+    def title(self, index):
+        """Get title of citation by index"""
+        return self.citations[index].get("title", "")
+
+    def __iter__(self):
+        """Iterate over kept pairs as report entries, best first"""
+        for index1, index2, similarity in self.pairs():
+            yield {
+                "index1": index1,
+                "index2": index2,
+                "title1": self.title(index1),
+                "title2": self.title(index2),
+                "similarity": similarity,
+            }
+
+    def __len__(self):
+        return len(self.pairs())
+
+    def close(self):
+        """Remove spill database, if any"""
+        if self.db:
+            self.db.close()
+            self.db = None
+        if self.db_path and os.path.exists(self.db_path):
+            os.remove(self.db_path)
+        self.db_path = None
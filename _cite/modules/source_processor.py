@@ -2,18 +2,32 @@
 Module for processing citation sources from various plugins with file logging
 """
 
+import copy
 import traceback
+from contextlib import nullcontext
+from concurrent.futures import Future
 from importlib import import_module
 from pathlib import Path
-from util import log, load_data, get_safe, label
-from modules.logging_module import log_to_file
+from util import log, load_data, get_safe, label, create_executors
+from modules.manifest import content_hash, entry_key
+import http_trace
 
-def process_sources(plugins):
+def process_sources(plugins, max_workers=1, plugin_concurrency=None, manifest=None, run_stats=None):
     """
     Process sources from all plugins
     
+    Plugin entries are expanded concurrently on a bounded worker pool, but
+    results are logged, tagged and compiled in the same order as a sequential
+    run (plugin order, then data file name, then entry order)
+    
     Args:
         plugins (list): List of plugin names to process
+        max_workers (int): Max number of entries expanded at once, across all plugins
+        plugin_concurrency (dict): Max number of entries expanded at once per plugin,
+            keyed by plugin name, with "default" used for unlisted plugins
+        manifest (Manifest): Results of last run, to reuse for unchanged entries
+            and to record this run's results in
+        run_stats (RunStats): Stats to add the time each plugin takes to
         
     Returns:
         tuple: (sources, all_sources, error_flag)
@@ -27,102 +41,268 @@ def process_sources(plugins):
     # store all original sources for reporting
     all_sources = []
     
-    # loop through plugins
-    for plugin in plugins:
-        # convert into path object
-        plugin = Path(f"plugins/{plugin}.py")
+    # find and load all data files before any plugin runs
+    jobs = load_plugin_data(plugins, manifest)
 
-        log(f"Running {plugin.stem} plugin")
-        log_to_file(f"Running {plugin.stem} plugin")
+    # one pool per plugin, all sharing a global limit on running entries
+    executors = create_executors(plugins, max_workers, plugin_concurrency)
 
-        # get all data files to process with current plugin
-        files = Path.cwd().glob(f"_data/{plugin.stem}*.*")
-        files = list(filter(lambda p: p.suffix in [".yaml", ".yml", ".json"], files))
+    try:
+        # submit every entry up front so slow plugins overlap with each other
+        for plugin, files in jobs:
+            for file in files:
+                file["keys"] = [entry_key(plugin.stem, entry) for entry in file["data"]]
+                # reuse sources of unchanged entries from last run
+                file["records"] = [
+                    manifest and manifest.get("entries", key, plugin.stem)
+                    for key in file["keys"]
+                ]
 
-        log(f"Found {len(files)} {plugin.stem}* data file(s)", 1)
-        log_to_file(f"Found {len(files)} {plugin.stem}* data file(s)", 1)
+                # let plugin look up entries that need running in bulk first
+                pending = [
+                    entry for entry, record in zip(file["data"], file["records"]) if not record
+                ]
+                if pending:
+                    prefetch_plugin(plugin.stem, pending, run_stats)
 
-        # loop through data files
-        for file in files:
-            log(f"Processing data file {file.name}", 1)
-            log_to_file(f"Processing data file {file.name}", 1)
+                file["futures"] = []
+                for index, (entry, record) in enumerate(zip(file["data"], file["records"])):
+                    if record:
+                        future = Future()
+                        future.set_result((copy.deepcopy(record["sources"]), None, None))
+                    else:
+                        # keep pristine copy of entry, sources can be the entry itself
+                        file["records"][index] = {"entry": copy.deepcopy(entry)}
+                        future = executors[plugin.stem].submit(run_plugin, plugin.stem, entry, run_stats)
+                    file["futures"].append(future)
 
-            # load data from file
-            try:
-                data = load_data(file)
-                # check if file in correct format
-                if not list_of_dicts(data):
-                    raise Exception("File not a list of dicts")
-            except Exception as e:
-                log(e, 2, "ERROR")
-                log_to_file(e, 2, "ERROR")
-                error = True
-                continue
-
-            # loop through data entries
-            for index, entry in enumerate(data):
-                log(f"Processing entry {index + 1} of {len(data)}, {label(entry)}", 2)
-                log_to_file(f"Processing entry {index + 1} of {len(data)}, {label(entry)}", 2)
-
-                # run plugin on data entry to expand into multiple sources
-                try:
-                    expanded = import_module(f"plugins.{plugin.stem}").main(entry)
-                    # check that plugin returned correct format
-                    if not list_of_dicts(expanded):
-                        raise Exception("Plugin didn't return list of dicts")
-                # catch any plugin error
-                except Exception as e:
-                    # log detailed pre-formatted/colored trace
-                    error_trace = traceback.format_exc()
-                    print(error_trace)
-                    log_to_file(error_trace)
-                    # log high-level error
-                    log(e, 3, "ERROR")
-                    log_to_file(e, 3, "ERROR")
+        # loop through plugins, collecting results in deterministic order
+        for plugin, files in jobs:
+            log(f"Running {plugin.stem} plugin")
+
+            log(f"Found {len(files)} {plugin.stem}* data file(s)", 1)
+
+            # loop through data files
+            for file in files:
+                log(f"Processing data file {file['path'].name}", 1)
+
+                # report file that could not be loaded
+                if file["error"]:
+                    log(file["error"], 2, "ERROR")
                     error = True
                     continue
 
-                # loop through sources
-                for source in expanded:
-                    if plugin.stem != "sources":
-                        log(label(source), 3)
-                        log_to_file(label(source), 3)
+                # loop through data entries
+                data = file["data"]
+                for index, (entry, future) in enumerate(zip(data, file["futures"])):
+                    log(f"Processing entry {index + 1} of {len(data)}, {label(entry)}", 2)
 
-                    # include meta info about source
-                    source["plugin"] = plugin.name
-                    source["file"] = file.name
-                    
-                    # Store original source for reporting
-                    all_sources.append(source.copy())
+                    # wait for plugin to expand data entry into multiple sources
+                    expanded, plugin_error, error_trace = future.result()
 
-                    # add source to compiled list
-                    sources.append(source)
+                    # record result of new or changed entry for next run
+                    record = file["records"][index]
+                    if manifest and not plugin_error and "sources" not in record:
+                        manifest.set("entries", file["keys"][index], {
+                            "entry": record["entry"],
+                            "sources": copy.deepcopy(expanded),
+                        })
 
-                if plugin.stem != "sources":
-                    log(f"{len(expanded)} source(s)", 3)
-                    log_to_file(f"{len(expanded)} source(s)", 3)
+                    # catch any plugin error
+                    if plugin_error:
+                        # log detailed pre-formatted trace
+                        log(error_trace)
+                        # log high-level error
+                        log(plugin_error, 3, "ERROR")
+                        error = True
+                        continue
+
+                    # loop through sources
+                    for source in expanded:
+                        if plugin.stem != "sources":
+                            log(label(source), 3)
+
+                        # include meta info about source
+                        source["plugin"] = plugin.name
+                        source["file"] = file["path"].name
+                        
+                        # Store original source for reporting
+                        all_sources.append(source.copy())
+
+                        # add source to compiled list
+                        sources.append(source)
+
+                    if plugin.stem != "sources":
+                        log(f"{len(expanded)} source(s)", 3)
+
+                # record data file, to skip parsing it next run if unchanged
+                if manifest:
+                    manifest.set_file(file["path"], file["hash"], file["keys"])
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=True)
 
     # Merge sources with matching IDs
     log("Merging sources by id")
-    log_to_file("Merging sources by id")
     
     # merge sources with matching (non-blank) ids
-    for a in range(0, len(sources)):
-        a_id = get_safe(sources, f"{a}.id", "")
-        if not a_id:
+    sources, stats = merge_sources(sources)
+
+    summary = (
+        f"Merged {stats['duplicates']} duplicate(s) of {stats['merged_ids']} id(s), "
+        f"{stats['without_id']} source(s) without id, "
+        f"{stats['output']} of {stats['input']} source(s) left"
+    )
+    log(summary, 1)
+
+    return sources, all_sources, error
+
+def merge_sources(sources):
+    """
+    Merge sources with matching (non-blank) ids in a single pass
+
+    Each source is merged into the first source with the same id, later
+    sources updating (overriding) fields of earlier ones, and the merged
+    source keeps the position of the first. Empty sources are dropped.
+
+    Args:
+        sources (list): List of source dictionaries
+
+    Returns:
+        tuple: (merged sources, merge statistics dict)
+    """
+    merged = []
+
+    # first source seen for each id
+    index = {}
+
+    # number of sources merged into each id
+    counts = {}
+
+    stats = {"input": len(sources), "without_id": 0}
+
+    for source in sources:
+        # Remove empty entries
+        if not source:
             continue
-        for b in range(a + 1, len(sources)):
-            b_id = get_safe(sources, f"{b}.id", "")
-            if b_id == a_id:
-                log(f"Found duplicate {b_id}", 2)
-                log_to_file(f"Found duplicate {b_id}", 2)
-                sources[a].update(sources[b])
-                sources[b] = {}
-    
-    # Remove empty entries
-    sources = [entry for entry in sources if entry]
+
+        _id = get_safe(source, "id", "")
+        if not _id:
+            stats["without_id"] += 1
+            merged.append(source)
+            continue
+
+        first = index.get(_id)
+        if first is None:
+            index[_id] = source
+            merged.append(source)
+            continue
+
+        log(f"Found duplicate {_id}", 2)
+        first.update(source)
+        counts[_id] = counts.get(_id, 0) + 1
+
+    stats["output"] = len(merged)
+    stats["unique_ids"] = len(index)
+    stats["duplicates"] = sum(counts.values())
+    stats["merged_ids"] = len(counts)
+
+    return merged, stats
+
+def load_plugin_data(plugins, manifest=None):
+    """
+    Find and load the data files of each plugin
+
+    Args:
+        plugins (list): List of plugin names to process
+        manifest (Manifest): Results of last run, to take entries of unchanged
+            data files from
+
+    Returns:
+        list: (plugin path, files) pairs, where each file is a dict with "path",
+            "hash" (content hash), "data" (list of entries) and "error" (load error or None)
+    """
+    jobs = []
+
+    for plugin in plugins:
+        # convert into path object
+        plugin = Path(f"plugins/{plugin}.py")
+
+        # get all data files to process with current plugin, in stable order
+        files = Path.cwd().glob(f"_data/{plugin.stem}*.*")
+        files = sorted(filter(lambda p: p.suffix in [".yaml", ".yml", ".json"], files))
+
+        loaded = []
+        for file in files:
+            # load data from file
+            try:
+                file_hash = content_hash(file.read_bytes())
+                # take entries of unchanged file from last run
+                data = manifest and manifest.get_file(file, file_hash)
+                if data:
+                    data = copy.deepcopy(data)
+                else:
+                    data = load_data(file)
+                # check if file in correct format
+                if not list_of_dicts(data):
+                    raise Exception("File not a list of dicts")
+                loaded.append({"path": file, "hash": file_hash, "data": data, "error": None})
+            except Exception as e:
+                loaded.append({"path": file, "hash": None, "data": [], "error": e})
+
+        jobs.append((plugin, loaded))
+
+    return jobs
+
+def prefetch_plugin(plugin, entries, run_stats=None):
+    """
+    Run optional prefetch(entries) hook of plugin on the entries of a data file
+    before they are expanded, so the plugin can look them up in bulk. Errors are
+    only warned about, since entries can still be expanded one by one.
     
-    return sources, all_sources, error
+    Args:
+        plugin (str): Plugin name
+        entries (list): Data file entries that will be expanded
+        run_stats (RunStats): Stats to add the time prefetching takes to
+    """
+    # plugin that can't be imported is reported when its entries are run
+    try:
+        module = import_module(f"plugins.{plugin}")
+    except Exception:
+        return
+    if not hasattr(module, "prefetch"):
+        return
+    try:
+        with http_trace.subject(f"{plugin} prefetch"), (
+            run_stats.plugin_call(plugin, prefetch=True) if run_stats else nullcontext()
+        ):
+            module.prefetch(entries)
+    except Exception as e:
+        log(f"Couldn't prefetch {plugin} entries: {e}", 1, "WARNING")
+
+def run_plugin(plugin, entry, run_stats=None):
+    """
+    Run plugin on a single data entry, capturing any error instead of raising
+
+    Args:
+        plugin (str): Plugin name
+        entry (dict): Data file entry
+        run_stats (RunStats): Stats to add the time the plugin takes to
+
+    Returns:
+        tuple: (expanded sources, error or None, formatted traceback or None)
+    """
+    try:
+        with http_trace.subject(label(entry)), (
+            run_stats.plugin_call(plugin) if run_stats else nullcontext()
+        ):
+            expanded = import_module(f"plugins.{plugin}").main(entry)
+        # check that plugin returned correct format
+        if not list_of_dicts(expanded):
+            raise Exception("Plugin didn't return list of dicts")
+        return expanded, None, None
+    except Exception as e:
+        return [], e, traceback.format_exc()
 
 def list_of_dicts(data):
     """Check if data is a list of dictionaries"""
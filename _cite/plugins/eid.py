@@ -6,10 +6,19 @@ Place this file at _cite/plugins/eid.py to replace the existing one
 import os
 import re
 import json
+import threading
 import requests
 from urllib.parse import quote
 from datetime import datetime
-from util import log, get_safe, cache
+from util import log, get_safe, memoize, record_failure, cached_failure, failure_message, TRANSIENT_FAILURE_EXPIRE
+from http_client import get as http_get
+
+# Max EIDs per Scopus Search query, and results per page
+search_batch_size = 25
+
+# Search results of prefetched EIDs, by EID
+prefetched = {}
+prefetched_lock = threading.Lock()
 
 def extract_id_from_eid(eid):
     """Extract the numeric portion from a Scopus EID"""
@@ -32,25 +41,193 @@ def query_scopus_direct(eid, api_key):
     
     url = f"https://api.elsevier.com/content/abstract/scopus_id/{eid}"
     
+    # id that failures are recorded under, same as in data files
+    eid_value = f"eid:2-s2.0-{eid}"
+    
     try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
+        response = http_get(url, headers=headers)
         return response.json()
     except requests.exceptions.HTTPError as http_err:
         log(f"HTTP error occurred: {http_err}", level="WARNING")
+        status = getattr(http_err.response, "status_code", None) or 0
+        # rate limits and server errors are likely to pass, other statuses (e.g. 404) are definite
+        transient = status == 429 or status >= 500
+        record_failure(
+            "scopus_citation", eid_value, f"http_{status or ''}", http_err,
+            expire=TRANSIENT_FAILURE_EXPIRE if transient else None,
+        )
         return None
     except requests.exceptions.ConnectionError as conn_err:
         log(f"Connection error occurred: {conn_err}", level="WARNING")
+        record_failure("scopus_citation", eid_value, "connection_error", conn_err, expire=TRANSIENT_FAILURE_EXPIRE)
         return None
     except requests.exceptions.Timeout as timeout_err:
         log(f"Timeout error occurred: {timeout_err}", level="WARNING")
+        record_failure("scopus_citation", eid_value, "timeout", timeout_err, expire=TRANSIENT_FAILURE_EXPIRE)
+        return None
+    except ValueError as parse_err:
+        # response that isn't json, a RequestException too in newer requests
+        log(f"Invalid response from Scopus API: {parse_err}", level="WARNING")
+        record_failure("scopus_citation", eid_value, "parse_error", parse_err)
         return None
     except requests.exceptions.RequestException as req_err:
         log(f"Request error occurred: {req_err}", level="WARNING")
+        record_failure("scopus_citation", eid_value, "request_error", req_err, expire=TRANSIENT_FAILURE_EXPIRE)
         return None
     except Exception as e:
         log(f"Error querying Scopus API: {e}", level="WARNING")
+        record_failure("scopus_citation", eid_value, "error", e, expire=TRANSIENT_FAILURE_EXPIRE)
+        return None
+
+# Cache the API request to avoid repeated calls, api key is not part of the cache key
+@memoize(name="scopus_citation", expire=30 * (60 * 60 * 24), ignore={1})
+def query_scopus(eid, api_key):
+    data = query_scopus_direct(eid, api_key)
+    # failures are remembered for a shorter time by record_failure, not here
+    if data is None:
+        raise LookupError(f"No Scopus data for {eid}")
+    return data
+
+@memoize(name="scopus_search", expire=30 * (60 * 60 * 24), ignore={1})
+def search_scopus(eids, api_key):
+    """
+    Query Scopus Search API for a batch of EIDs at once
+    
+    Args:
+        eids (tuple): Scopus EIDs (e.g. 2-s2.0-XXXXXXXXXX), at most search_batch_size
+        api_key (str): Scopus API key
+        
+    Returns:
+        dict: EID to search result entry, for EIDs that were found
+    """
+    headers = {
+        "X-ELS-APIKey": api_key,
+        "Accept": "application/json"
+    }
+    params = {
+        "query": " OR ".join(f"EID({eid})" for eid in eids),
+        "view": "COMPLETE",
+        "count": search_batch_size,
+        "start": 0,
+    }
+    
+    results = {}
+    while True:
+        response = http_get(
+            "https://api.elsevier.com/content/search/scopus", params=params, headers=headers
+        )
+        entries = get_safe(response.json(), "search-results.entry", [])
+        for entry in entries:
+            # a search without results has a single entry with an error
+            if entry.get("eid"):
+                results[entry["eid"]] = entry
+        if len(entries) < search_batch_size:
+            break
+        params["start"] += search_batch_size
+    
+    return results
+
+def prefetch(entries):
+    """
+    Resolve all EIDs of a data file with batched Scopus Search queries, so main
+    only needs abstract retrieval for EIDs the search didn't find
+    
+    Args:
+        entries (list): Data file entries that main will be run on
+    """
+    api_key = os.environ.get("SCOPUS_API_KEY")
+    if not api_key:
+        return
+    
+    # EIDs that main would look up in Scopus
+    eids = []
+    for entry in entries:
+        _id = get_safe(entry, "id", "").strip()
+        if not _id.startswith("eid:") or complete_entry(entry):
+            continue
+        # placeholders bypass caches, left to main
+        if entry.get("authors") == ["Please Update Manually"]:
+            continue
+        eids.append(_id.replace("eid:", ""))
+    eids = sorted(set(eids))
+    
+    found = {}
+    for start in range(0, len(eids), search_batch_size):
+        batch = tuple(eids[start:start + search_batch_size])
+        try:
+            found.update(search_scopus(batch, api_key))
+        except Exception as e:
+            log(f"Scopus search failed, falling back to per-EID retrieval: {e}", 1, "WARNING")
+    
+    log(f"Found {len(found)} of {len(eids)} EID(s) with Scopus search", 1)
+    with prefetched_lock:
+        prefetched.update(found)
+
+def search_entry_to_citation(eid_value, entry):
+    """
+    Create citation data from a Scopus Search result entry
+    
+    Args:
+        eid_value (str): Scopus EID in format 'eid:2-s2.0-XXXXXXXXXX'
+        entry (dict): Search result entry (COMPLETE view)
+        
+    Returns:
+        dict: Citation data, or None if the entry lacks a title or authors
+    """
+    title = get_safe(entry, "dc:title", "")
+    
+    authors = []
+    for author in get_safe(entry, "author", []) or []:
+        given_name = get_safe(author, "given-name", "") or ""
+        surname = get_safe(author, "surname", "") or ""
+        full_name = " ".join(part for part in [given_name, surname] if part).strip()
+        if not full_name:
+            full_name = (get_safe(author, "authname", "") or "").strip()
+        if full_name:
+            authors.append(full_name)
+    
+    if not title or not authors:
         return None
+    
+    doi = get_safe(entry, "prism:doi", "")
+    publisher = get_safe(entry, "prism:publicationName", "") or "Unknown Publication"
+    
+    date = parse_scopus_date(get_safe(entry, "prism:coverDate", "") or "")
+    if not date:
+        date = f"{datetime.now().year}-01-01"
+    
+    link = get_safe(entry, "prism:url", "")
+    if not link and doi:
+        link = f"https://doi.org/{doi}"
+    if not link:
+        link = f"https://www.scopus.com/record/display.uri?eid={eid_value.replace('eid:', '')}"
+    
+    return {
+        "id": f"doi:{doi}" if doi else eid_value,
+        "original_id": eid_value,
+        "title": title,
+        "authors": authors,
+        "publisher": publisher,
+        "date": date,
+        "link": link
+    }
+
+def parse_scopus_date(date_str):
+    """Format start of a Scopus date (e.g. 2021-02-03, 2021-02, 2021) as YYYY-MM-DD, or "" if malformed"""
+    # (format, length of dates in that format)
+    for fmt, length in [("%Y-%m-%d", 10), ("%Y-%m", 7), ("%Y", 4)]:
+        try:
+            return datetime.strptime(date_str[:length], fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return ""
+
+def complete_entry(entry):
+    """Check if manual entry data is complete, so Scopus isn't needed"""
+    return bool(
+        entry.get("title") and entry.get("authors") and entry.get("publisher")
+        and entry.get("authors") != ["Please Update Manually"]
+    )
 
 def get_citation_from_scopus(eid_value, force_refresh=False):
     """
@@ -74,17 +251,21 @@ def get_citation_from_scopus(eid_value, force_refresh=False):
         log(f"Could not extract Scopus ID from {eid_value}", level="WARNING")
         return None
     
+    # Skip EID that failed recently, unless refreshing anyway
+    failure = None if force_refresh else cached_failure("scopus_citation", eid_value)
+    if failure:
+        log(f"{eid_value}: {failure_message(failure)}", level="WARNING")
+        return None
+    
     # Get data either from cache or direct API call
     if force_refresh:
         log(f"Forcing refresh for {eid_value}, bypassing cache", level="INFO")
         data = query_scopus_direct(scopus_id, api_key)
     else:
-        # Cache the API request to avoid repeated calls
-        @cache.memoize(name="scopus_citation", expire=30 * (60 * 60 * 24))
-        def query_scopus(eid):
-            return query_scopus_direct(eid, api_key)
-        
-        data = query_scopus(scopus_id)
+        try:
+            data = query_scopus(scopus_id, api_key)
+        except LookupError:
+            data = None
     
     if not data:
         log(f"Failed to retrieve data from Scopus API for ID: {eid_value}", level="WARNING")
@@ -95,6 +276,7 @@ def get_citation_from_scopus(eid_value, force_refresh=False):
         # Check if we have the abstract retrieval response
         if 'abstracts-retrieval-response' not in data:
             log(f"Unexpected API response format for ID: {eid_value}", level="WARNING")
+            record_failure("scopus_citation", eid_value, "parse_error", "Unexpected API response format")
             return None
             
         coredata = get_safe(data, "abstracts-retrieval-response.coredata", {})
@@ -211,18 +393,9 @@ def get_citation_from_scopus(eid_value, force_refresh=False):
         for field in date_fields:
             date_str = get_safe(coredata, field, "")
             if date_str:
-                try:
-                    for fmt in ["%Y-%m-%d", "%Y-%m", "%Y"]:
-                        try:
-                            parsed_date = datetime.strptime(date_str[:len(fmt)], fmt)
-                            date = parsed_date.strftime("%Y-%m-%d")
-                            break
-                        except ValueError:
-                            continue
-                    if date:
-                        break
-                except Exception:
-                    pass
+                date = parse_scopus_date(date_str)
+                if date:
+                    break
         if not date:
             date = f"{datetime.now().year}-01-01"
         
@@ -274,7 +447,7 @@ def main(entry):
         raise Exception('ID must start with "eid:"')
     
     # Check if manual entry data is complete
-    if entry.get("title") and entry.get("authors") and entry.get("publisher") and entry.get("authors") != ["Please Update Manually"]:
+    if complete_entry(entry):
         log(f"Using existing complete entry data for {_id}", 1)
         return [entry]
     
@@ -284,8 +457,14 @@ def main(entry):
         log(f"Entry {_id} has placeholder authors, forcing API refresh", 1, "INFO")
         force_refresh = True
     
-    # Get citation data
-    citation = get_citation_from_scopus(_id, force_refresh=force_refresh)
+    # Get citation data, from batched search if prefetched, otherwise by itself
+    citation = None
+    with prefetched_lock:
+        search_entry = prefetched.get(_id.replace("eid:", ""))
+    if search_entry and not force_refresh:
+        citation = search_entry_to_citation(_id, search_entry)
+    if not citation:
+        citation = get_citation_from_scopus(_id, force_refresh=force_refresh)
     
     if citation and citation.get("title") and citation.get("authors"):
         log(f"Successfully retrieved citation data for {_id}", 1, "SUCCESS")
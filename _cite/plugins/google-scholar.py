@@ -1,7 +1,19 @@
 import os
 import re
-from serpapi import GoogleSearch
+from concurrent.futures import ThreadPoolExecutor
 from util import *
+from http_client import get_json
+import http_trace
+
+# serp api
+endpoint = "https://serpapi.com/search.json"
+
+# articles per page, max allowed by serp api
+page_size = 100
+
+# pages requested at once after the first, and max pages in total
+page_workers = 3
+max_pages = 20
 
 def extract_doi_from_url(url):
     """
@@ -63,6 +75,34 @@ def extract_doi_from_metadata(title, authors, year):
     # Create a synthetic ID that mimics a DOI but is flagged as synthetic
     return f"gs-id:{first_author}.{year}.{slug}"
 
+def query_pages(query):
+    """
+    get articles of all pages, in page order
+
+    every search is paid for, so only pages known to have articles are
+    requested. if the first page tells the total number of articles, the
+    remaining pages are requested concurrently, otherwise one at a time while
+    the last page is full and has a next page
+    """
+
+    pages = [query(0)]
+    total = pages[0]["total"]
+
+    if total:
+        starts = range(page_size, min(total, max_pages * page_size), page_size)
+        with ThreadPoolExecutor(max_workers=page_workers) as executor:
+            pages += executor.map(http_trace.bind(query), starts)
+        more = total > max_pages * page_size
+    else:
+        while len(pages[-1]["articles"]) >= page_size and pages[-1]["next"] and len(pages) < max_pages:
+            pages.append(query(len(pages) * page_size))
+        more = len(pages[-1]["articles"]) >= page_size and pages[-1]["next"]
+
+    if more:
+        log(f"Stopped after {max_pages} pages, more articles may exist", 3, "WARNING")
+
+    return [article for page in pages for article in page["articles"]]
+
 def main(entry):
     """
     receives single list entry from google-scholar data file
@@ -78,7 +118,7 @@ def main(entry):
     params = {
         "engine": "google_scholar_author",
         "api_key": api_key,
-        "num": 100,  # max allowed
+        "num": page_size,
     }
 
     # get id from entry
@@ -86,14 +126,30 @@ def main(entry):
     if not _id:
         raise Exception('No "gsid" key')
 
-    # query api
-    @log_cache
-    @cache.memoize(name=__file__, expire=1 * (60 * 60 * 24))
-    def query(_id):
-        params["author_id"] = _id
-        return get_safe(GoogleSearch(params).get_dict(), "articles", [])
+    # query api, one page of articles at a time, with whether more pages exist
+    # (namespace apart from older cached lists of articles)
+    @memoize(name=f"{__file__}.pages", expire=1 * (60 * 60 * 24))
+    def query(_id, start):
+        page_params = {**params, "author_id": _id, "start": start}
+        response = get_json(endpoint, params=page_params)
+        articles = get_safe(response, "articles", [])
+        error = get_safe(response, "error", "")
+        # page past the last article has no results, which serp api reports as
+        # an error of a search that still succeeded
+        finished = (
+            get_safe(response, "search_metadata.status", "") == "Success"
+            or get_safe(response, "search_information.organic_results_state", "") == "Fully empty"
+        )
+        if error and not articles and not finished:
+            raise Exception(f"SerpApi error: {error}")
+        total = get_safe(response, "search_information.total_results", 0)
+        return {
+            "articles": articles,
+            "total": total if isinstance(total, int) else 0,
+            "next": bool(get_safe(response, "serpapi_pagination.next", "")),
+        }
 
-    response = query(_id)
+    response = query_pages(lambda start: query(_id, start))
 
     # list of sources to return
     sources = []
@@ -1,6 +1,13 @@
-import json
-from urllib.request import Request, urlopen
 from util import *
+from http_client import get_json_cached
+
+
+# orcid api
+endpoint = "https://pub.orcid.org/v3.0/$ORCID/works"
+headers = {"Accept": "application/json"}
+
+# max put-codes per bulk works request, limit of orcid api
+batch_size = 100
 
 
 def main(entry):
@@ -9,31 +16,45 @@ def main(entry):
     returns list of sources to cite
     """
 
-    # orcid api
-    endpoint = "https://pub.orcid.org/v3.0/$ORCID/works"
-    headers = {"Accept": "application/json"}
-
     # get id from entry
     _id = get_safe(entry, "orcid", "")
     if not _id:
         raise Exception('No "orcid" key')
 
     # query api
-    @log_cache
-    @cache.memoize(name=__file__, expire=1 * (60 * 60 * 24))
+    @memoize(name=__file__, expire=1 * (60 * 60 * 24))
     def query(_id):
-        url = endpoint.replace("$ORCID", _id)
-        request = Request(url=url, headers=headers)
-        response = json.loads(urlopen(request).read())
+        response = get_json_cached(endpoint.replace("$ORCID", _id), headers=headers)
         return get_safe(response, "group", [])
 
+    # query full work records in bulk
+    @memoize(name=f"{__file__}.works", expire=1 * (60 * 60 * 24))
+    def query_works(_id, put_codes):
+        response = get_json_cached(
+            endpoint.replace("$ORCID", _id) + "/" + put_codes, headers=headers
+        )
+        return [get_safe(item, "work", {}) for item in get_safe(response, "bulk", [])]
+
     response = query(_id)
 
+    # put-code of preferred (first) summary of each work
+    put_codes = [
+        str(get_safe(work, "work-summary.0.put-code", "")) for work in response
+    ]
+    codes = [code for code in put_codes if code]
+
+    # full records by put-code
+    details = {}
+    for start in range(0, len(codes), batch_size):
+        batch = ",".join(codes[start : start + batch_size])
+        for work in query_works(_id, batch):
+            details[str(get_safe(work, "put-code", ""))] = work
+
     # list of sources to return
     sources = []
 
     # go through response structure and pull out ids e.g. doi:1234/56789
-    for work in response:
+    for work, put_code in zip(response, put_codes):
         # get list of ids
         ids = get_safe(work, "external-ids.external-id", [])
         for summary in get_safe(work, "work-summary", []):
@@ -52,8 +73,15 @@ def main(entry):
         # create source
         source = {"id": f"{id_type}:{id_value}"}
 
+        # use full record if it has all citation details, Manubot not needed
+        citation = work_to_citation(details.get(put_code, {}))
+        if citation["title"] and citation["authors"] and citation["date"]:
+            if not citation["link"] and id_type == "doi":
+                citation["link"] = f"https://doi.org/{id_value}"
+            source.update({key: value for key, value in citation.items() if value})
+
         # if not a doi, Manubot likely can't cite, so keep citation details
-        if id_type != "doi":
+        elif id_type != "doi":
             # get summaries
             summaries = get_safe(work, "work-summary", [])
 
@@ -107,3 +135,32 @@ def main(entry):
         sources.append(source)
 
     return sources
+
+
+def work_to_citation(work):
+    """
+    convert full orcid work record into citation with only needed info
+    """
+
+    # authors, from contributor credit names
+    authors = []
+    for contributor in get_safe(work, "contributors.contributor", []) or []:
+        name = (get_safe(contributor, "credit-name.value", "") or "").strip()
+        if name:
+            authors.append(name)
+
+    # date, with fallbacks for month and day
+    year = get_safe(work, "publication-date.year.value", "")
+    date = ""
+    if year:
+        month = get_safe(work, "publication-date.month.value", "") or "1"
+        day = get_safe(work, "publication-date.day.value", "") or "1"
+        date = format_date(f"{year}-{month}-{day}")
+
+    return {
+        "title": (get_safe(work, "title.title.value", "") or "").strip(),
+        "authors": authors,
+        "publisher": (get_safe(work, "journal-title.value", "") or "").strip(),
+        "date": date,
+        "link": (get_safe(work, "url.value", "") or "").strip(),
+    }
@@ -1,7 +1,13 @@
-import json
-from urllib.request import Request, urlopen
-from urllib.parse import quote
+from xml.etree import ElementTree
 from util import *
+from http_client import get, get_json
+
+
+# ncbi api
+eutils = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils"
+
+# articles fetched per efetch request
+batch_size = 200
 
 
 def main(entry):
@@ -10,22 +16,34 @@ def main(entry):
     returns list of sources to cite
     """
 
-    # ncbi api
-    endpoint = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=pubmed&term=$TERM&retmode=json&retmax=1000&usehistory=y"
-
     # get id from entry
     _id = get_safe(entry, "term", "")
     if not _id:
         raise Exception('No "term" key')
 
-    # query api
-    @log_cache
-    @cache.memoize(name=__file__, expire=1 * (60 * 60 * 24))
+    # query api, namespace apart from older cached lists of pmids
+    @memoize(name=f"{__file__}.efetch", expire=1 * (60 * 60 * 24))
     def query(_id):
-        url = endpoint.replace("$TERM", quote(_id))
-        request = Request(url=url)
-        response = json.loads(urlopen(request).read())
-        return get_safe(response, "esearchresult.idlist", [])
+        # search once, keeping results on the server
+        params = {"db": "pubmed", "term": _id, "retmode": "json", "retmax": 0, "usehistory": "y"}
+        response = get_json(f"{eutils}/esearch.fcgi", params=params)
+        count = int(get_safe(response, "esearchresult.count", 0))
+        webenv = get_safe(response, "esearchresult.webenv", "")
+        query_key = get_safe(response, "esearchresult.querykey", "")
+
+        # fetch full records of results in pages
+        articles = []
+        for start in range(0, count, batch_size):
+            params = {
+                "db": "pubmed",
+                "retmode": "xml",
+                "query_key": query_key,
+                "WebEnv": webenv,
+                "retstart": start,
+                "retmax": batch_size,
+            }
+            articles += parse_articles(get(f"{eutils}/efetch.fcgi", params=params).content)
+        return articles
 
     response = query(_id)
 
@@ -33,9 +51,9 @@ def main(entry):
     sources = []
 
     # go through response and format sources
-    for _id in response:
-        # create source
-        source = {"id": f"pubmed:{_id}"}
+    for citation in response:
+        # create source, with full citation details when available
+        source = dict(citation)
 
         # copy fields from entry to source
         source.update(entry)
@@ -44,3 +62,30 @@ def main(entry):
         sources.append(source)
 
     return sources
+
+
+def parse_articles(xml):
+    """
+    parse efetch xml into citations, same as Manubot would make, without
+    empty fields so Manubot can fill them in later, or just id if article
+    can't be parsed (e.g. book)
+    """
+
+    # import here, manubot is slow to import and only needed on cache misses
+    from manubot.cite.pubmed import csl_item_from_pubmed_article
+
+    citations = []
+    for article in ElementTree.fromstring(xml):
+        pmid = article.findtext("MedlineCitation/PMID") or article.findtext(
+            "BookDocument/PMID"
+        )
+        if not pmid:
+            continue
+        _id = f"pubmed:{pmid}"
+        try:
+            citation = manubot_to_citation(_id, csl_item_from_pubmed_article(article))
+            citations.append({key: value for key, value in citation.items() if value})
+        except Exception:
+            citations.append({"id": _id})
+
+    return citations
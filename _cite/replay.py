@@ -0,0 +1,143 @@
+"""
+record http traffic of a run to an archive, and replay it later without
+network, by hooking every request made through the requests library
+(plugins, via http_client, and Manubot)
+"""
+
+import gzip
+import json
+import time
+import base64
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+
+# query parameters left out of archive, so api keys aren't saved
+SECRET_PARAMS = {"api_key", "apikey", "key", "token"}
+
+# headers that no longer apply once body is decoded
+DROP_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+
+# original send method of requests, while hooked
+_send = None
+
+# recorded responses by request key, in order made
+_archive = {}
+_archive_lock = threading.Lock()
+
+# how many times each request key was replayed
+_replayed = {}
+
+
+def request_key(request):
+    """
+    get archive key of request, its method and url without secret parameters,
+    and a hash of its body if any
+    """
+
+    parts = urlsplit(request.url)
+    query = [
+        (name, value)
+        for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if name.lower() not in SECRET_PARAMS
+    ]
+    url = urlunsplit(parts._replace(query=urlencode(query)))
+    key = f"{request.method} {url}"
+    if request.body:
+        body = request.body if isinstance(request.body, bytes) else str(request.body).encode()
+        key += f" {base64.b64encode(body[:64]).decode()}#{len(body)}"
+    return key
+
+
+def record(path):
+    """
+    send requests as usual, saving each response to archive at path
+    (gzipped json) when stop is called
+    """
+
+    global _send
+    _send = HTTPAdapter.send
+
+    def send(adapter, request, *args, **kwargs):
+        start = time.perf_counter()
+        response = _send(adapter, request, *args, **kwargs)
+        entry = {
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": {
+                name: value
+                for name, value in response.headers.items()
+                if name.lower() not in DROP_HEADERS
+            },
+            "body": base64.b64encode(response.content).decode(),
+            "seconds": time.perf_counter() - start,
+        }
+        with _archive_lock:
+            _archive.setdefault(request_key(request), []).append(entry)
+        return response
+
+    HTTPAdapter.send = send
+
+    def stop():
+        HTTPAdapter.send = _send
+        with gzip.open(path, "wt", encoding="utf-8") as file:
+            json.dump(_archive, file)
+
+    return stop
+
+
+def replay(path, latency=None):
+    """
+    answer requests from archive at path instead of network. repeated
+    requests get their recorded responses in order, then the last one again.
+    requests not in archive fail like an unreachable host
+
+    latency: seconds to wait per request, "recorded" to wait as long as
+    the recorded request took, None to not wait
+    """
+
+    global _send
+    _send = HTTPAdapter.send
+
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        archive = json.load(file)
+
+    def send(adapter, request, *args, **kwargs):
+        key = request_key(request)
+        entries = archive.get(key)
+        if not entries:
+            raise requests.exceptions.ConnectionError(
+                f"No recorded response for {key}", request=request
+            )
+
+        with _archive_lock:
+            index = _replayed.get(key, 0)
+            _replayed[key] = index + 1
+        entry = entries[min(index, len(entries) - 1)]
+
+        if latency == "recorded":
+            time.sleep(entry["seconds"])
+        elif latency:
+            time.sleep(float(latency))
+
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.reason = entry["reason"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = base64.b64decode(entry["body"])
+        response.url = request.url
+        response.request = request
+        response.connection = adapter
+        return response
+
+    HTTPAdapter.send = send
+
+    def stop():
+        HTTPAdapter.send = _send
+
+    return stop
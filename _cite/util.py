@@ -2,57 +2,317 @@
 utility functions for cite process and plugins
 """
 
-import subprocess
-import json
+import os
+import time
+import functools
+import threading
 import yaml
-from yaml.loader import SafeLoader
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
-from rich import print
 from diskcache import Cache
+from diskcache.core import args_to_key
+from modules.logging_module import log_message
+import http_trace
+
+
+# yaml loader and dumper, C-accelerated if PyYAML was built with libyaml
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+
+class NoAliasDumper(SafeDumper):
+    """
+    yaml dumper that writes repeated objects in full, instead of as
+    anchors/aliases (pointers)
+    """
+
+    def ignore_aliases(self, data):
+        return True
+
+
+# repo root, that relative cache paths are resolved against
+ROOT = Path(__file__).resolve().parent.parent
+
+
+# settings of cache for time-consuming network requests, see configure_cache
+cache_settings = {
+    "path": ROOT / "_cite/.cache",
+    "size_limit": 2**30,
+    "eviction_policy": "least-recently-stored",
+    "failure_expire": 3 * (60 * 60 * 24),
+}
+
+# opened cache, once first used
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def configure_cache(path=None, size_limit=None, eviction_policy=None, failure_expire=None):
+    """
+    set where cache is kept (relative to repo root), its max size in bytes,
+    which items go first when over it (a diskcache eviction policy), and
+    how long failed lookups are remembered in seconds (see record_failure).
+    path, size and policy only affect cache if not opened yet
+    """
+
+    if path is not None:
+        cache_settings["path"] = ROOT / path
+    if size_limit is not None:
+        cache_settings["size_limit"] = size_limit
+    if eviction_policy is not None:
+        cache_settings["eviction_policy"] = eviction_policy
+    if failure_expire is not None:
+        cache_settings["failure_expire"] = failure_expire
+
+
+def open_cache():
+    """
+    get cache, opening it on first use. items aren't culled when set, only
+    when cache is closed (see close_cache), so writes stay cheap
+    """
+
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = Cache(
+                str(cache_settings["path"]),
+                size_limit=cache_settings["size_limit"],
+                eviction_policy=cache_settings["eviction_policy"],
+                cull_limit=0,
+            )
+        return _cache
+
+
+def close_cache():
+    """
+    clear expired items, evict items over size limit, and close cache,
+    if it was opened. meant to run at end of run
+    """
+
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            return
+        _cache.expire()
+        _cache.cull()
+        _cache.close()
+        _cache = None
+
+
+class LazyCache:
+    """
+    stand-in for cache that only opens it when first used, so importing
+    this module (or decorating functions with memoize) costs nothing
+    """
+
+    def __getattr__(self, name):
+        return getattr(open_cache(), name)
+
+    def __contains__(self, key):
+        return key in open_cache()
+
+    def __getitem__(self, key):
+        return open_cache()[key]
+
+    def __setitem__(self, key, value):
+        open_cache()[key] = value
+
+    def __delitem__(self, key):
+        del open_cache()[key]
+
+    def __iter__(self):
+        return iter(open_cache())
+
+    def __len__(self):
+        return len(open_cache())
 
 
 # cache for time-consuming network requests
-cache = Cache("./_cite/.cache")
+cache = LazyCache()
 
 
-# clear expired items from cache
-cache.expire()
+# marks cache misses, since None can be a cached value
+_missing = object()
 
+# hit/miss counts and seconds spent, per cache namespace
+_cache_stats = {}
+_cache_stats_lock = threading.Lock()
 
-def log_cache(func):
+
+def record_cache(namespace, hit, seconds):
     """
-    decorator to use around memoized function to log if cached or or not
+    count cache hit or miss of namespace, and time it took
     """
 
-    def wrap(*args):
-        key = func.__cache_key__(*args)
-        if key in cache:
-            log(" (from cache)", level="INFO", newline=False)
-        return func(*args)
+    with _cache_stats_lock:
+        stats = _cache_stats.setdefault(
+            namespace, {"hits": 0, "misses": 0, "hit_seconds": 0.0, "miss_seconds": 0.0}
+        )
+        if hit:
+            stats["hits"] += 1
+            stats["hit_seconds"] += seconds
+        else:
+            stats["misses"] += 1
+            stats["miss_seconds"] += seconds
 
-    return wrap
 
+def cache_stats():
+    """
+    get hit/miss counts, hit rate and mean latency (ms) per cache namespace
+    """
 
-def log(message="\n--------------------\n", indent=0, level="", newline=True):
+    with _cache_stats_lock:
+        stats = {name: dict(values) for name, values in _cache_stats.items()}
+
+    for values in stats.values():
+        total = values["hits"] + values["misses"]
+        values["hit_rate"] = round(values["hits"] / total, 3) if total else 0
+        values["mean_hit_ms"] = round(
+            1000 * values["hit_seconds"] / values["hits"], 2
+        ) if values["hits"] else 0
+        values["mean_miss_ms"] = round(
+            1000 * values["miss_seconds"] / values["misses"], 2
+        ) if values["misses"] else 0
+
+    return dict(sorted(stats.items()))
+
+
+def memoize(name, expire=None, ignore=()):
+    """
+    decorator to cache results of function in cache, keyed by name and
+    arguments (same keys as diskcache memoize). looks key up once, logs if
+    result is from cache, and counts hits/misses (see cache_stats)
+    """
+
+    # plugins use their file path as name, count them by file name
+    namespace = Path(name).name
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrap(*args, **kwargs):
+            start = time.perf_counter()
+            key = wrap.__cache_key__(*args, **kwargs)
+            result = cache.get(key, default=_missing, retry=True)
+
+            if result is not _missing:
+                record_cache(namespace, True, time.perf_counter() - start)
+                log(" (from cache)", level="INFO", newline=False)
+                return result
+
+            result = func(*args, **kwargs)
+            cache.set(key, result, expire=expire, retry=True)
+            record_cache(namespace, False, time.perf_counter() - start)
+            return result
+
+        def __cache_key__(*args, **kwargs):
+            return args_to_key((name,), args, kwargs, False, ignore)
+
+        wrap.__cache_key__ = __cache_key__
+
+        return wrap
+
+    return decorator
+
+
+# failed lookups of this run, fresh or from cache, for report
+_failures = []
+_failures_lock = threading.Lock()
+
+# ids to look up again even if they failed recently
+_retry_ids = set()
+
+
+def retry_failures(ids):
+    """
+    forget cached failures of ids, so they're looked up again this run
+    """
+
+    _retry_ids.update(ids)
+
+
+def failure_key(namespace, _id):
+    """
+    get cache key of failed lookup of id
+    """
+
+    return ("failure", namespace, _id)
+
+
+# how long to remember failures that may be transient (e.g. timeouts), so
+# they're retried sooner than definite ones (e.g. http_404)
+TRANSIENT_FAILURE_EXPIRE = 60 * 60 * 6
+
+
+def record_failure(namespace, _id, reason, message="", expire=None):
     """
-    log to terminal, color determined by indent and level
+    remember that looking up id failed, with a short reason code (e.g.
+    not_found, http_404, timeout) and details, for expire seconds, or
+    failure_expire if not given
     """
 
-    palette = {
-        0: "[orange1]",
-        1: "[salmon1]",
-        2: "[violet]",
-        3: "[sky_blue1]",
-        "ERROR": "[white on #F43F5E]",
-        "WARNING": "[black on #EAB308]",
-        "SUCCESS": "[black on #10B981]",
-        "INFO": "[grey70]",
+    failure = {
+        "namespace": namespace,
+        "id": _id,
+        "reason": reason,
+        "message": str(message),
+        "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
     }
-    color = get_safe(palette, level, "") or get_safe(palette, indent, "") or "[white]"
-    if newline:
-        print()
-    print(indent * "    " + color + str(message) + "[/]", end="", flush=True)
+    if expire is None:
+        expire = cache_settings["failure_expire"]
+    else:
+        expire = min(expire, cache_settings["failure_expire"])
+    if expire:
+        cache.set(failure_key(namespace, _id), failure, expire=expire, retry=True)
+    with _failures_lock:
+        _failures.append({**failure, "cached": False})
+
+
+def cached_failure(namespace, _id):
+    """
+    get recent failure of looking up id, None if there is none or id is to
+    be retried (see retry_failures)
+    """
+
+    key = failure_key(namespace, _id)
+    if _id in _retry_ids:
+        cache.delete(key, retry=True)
+        return None
+    failure = cache.get(key, default=None, retry=True)
+    if failure:
+        with _failures_lock:
+            _failures.append({**failure, "cached": True})
+    return failure
+
+
+def failures():
+    """
+    get failed lookups of this run, including ones skipped as recently failed
+    """
+
+    with _failures_lock:
+        return list(_failures)
+
+
+def failure_message(failure):
+    """
+    describe cached failure, for errors of lookups it skips
+    """
+
+    return (
+        f"Skipped, failed recently ({failure['reason']}: {failure['message']}), "
+        f"use --retry {failure['id']} to retry now"
+    )
+
+
+def log(message="\n--------------------\n", indent=0, level="", newline=True):
+    """
+    log to terminal and log file, color determined by indent and level
+    """
+
+    log_message(message, indent, level, newline)
 
 
 def label(entry):
@@ -101,6 +361,44 @@ def format_date(date):
         return ""
 
 
+def create_executors(names, max_workers=1, concurrency=None):
+    """
+    create a thread pool per name (e.g. plugin or host), sized by its
+    concurrency limit, with all pools sharing a limit on running tasks
+    """
+
+    concurrency = concurrency or {}
+    max_workers = max(1, max_workers or 1)
+
+    # shared limit on running tasks, across all pools
+    global_limit = threading.BoundedSemaphore(max_workers)
+
+    executors = {}
+    for name in names:
+        workers = concurrency.get(name, concurrency.get("default", max_workers))
+        workers = max(1, min(workers or 1, max_workers))
+        executors[name] = LimitedExecutor(workers, global_limit, name)
+
+    return executors
+
+
+class LimitedExecutor(ThreadPoolExecutor):
+    """
+    thread pool whose tasks also hold a slot of a shared semaphore while running
+    """
+
+    def __init__(self, max_workers, limit, name=""):
+        super().__init__(max_workers=max_workers, thread_name_prefix=f"pool-{name}")
+        self.limit = limit
+
+    def submit(self, fn, *args, **kwargs):
+        def limited():
+            with self.limit:
+                return fn(*args, **kwargs)
+
+        return super().submit(limited)
+
+
 def load_data(path):
     """
     read data from yaml or json file
@@ -132,60 +430,177 @@ def load_data(path):
 
 def save_data(path, data):
     """
-    write data to yaml file
+    write data to yaml file, in one pass to a temporary file that then
+    replaces the original, so an interrupted run can't leave it half written
     """
 
     # convert to path object
     path = Path(path)
+    temp = path.with_name(path.name + ".tmp")
 
     # try to open file
     try:
-        file = open(path, mode="w")
+        file = open(temp, mode="w")
     except Exception:
         raise Exception("Can't open file for writing")
 
-    # prevent yaml anchors/aliases (pointers)
-    yaml.Dumper.ignore_aliases = lambda *args: True
-
-    # try to save data as yaml
+    # try to save warning note and data as yaml
     try:
         with file:
-            yaml.dump(data, file, default_flow_style=False, sort_keys=False)
+            file.write("# DO NOT EDIT, GENERATED AUTOMATICALLY\n\n")
+            yaml.dump(
+                data, file, Dumper=NoAliasDumper, default_flow_style=False, sort_keys=False
+            )
     except Exception:
+        temp.unlink(missing_ok=True)
         raise Exception("Can't save YAML to file")
 
-    # write warning note to top of file
-    note = "# DO NOT EDIT, GENERATED AUTOMATICALLY"
+    # swap in new file
     try:
-        with open(path, "r") as file:
-            data = file.read()
-        with open(path, "w") as file:
-            file.write(f"{note}\n\n{data}")
+        os.replace(temp, path)
     except Exception:
+        temp.unlink(missing_ok=True)
         raise Exception("Can't write to file")
 
 
-@log_cache
-@cache.memoize(name="manubot", expire=90 * (60 * 60 * 24))
-def cite_with_manubot(_id):
+# how long to keep Manubot citations in cache
+MANUBOT_EXPIRE = 90 * (60 * 60 * 24)
+
+
+@memoize(name="manubot", expire=MANUBOT_EXPIRE, ignore={"remember_failure"})
+def cite_with_manubot(_id, remember_failure=True):
     """
-    generate citation data for source id with Manubot
+    generate citation data for source id with Manubot. with remember_failure
+    off (e.g. for ids entered by user), recent failures of id aren't skipped
+    and new ones aren't recorded, so id is looked up every run until it works
     """
 
-    # run Manubot
+    # skip id that failed recently
+    failure = remember_failure and cached_failure("manubot", _id)
+    if failure:
+        raise Exception(failure_message(failure))
+
+    # run Manubot, errors of call itself aren't recorded as failures of id
     try:
-        commands = ["manubot", "cite", _id, "--log-level=WARNING"]
-        output = subprocess.Popen(commands, stdout=subprocess.PIPE).communicate()
+        manubot = query_manubot([_id]).get(_id)
     except Exception as e:
         log(e, 3)
         raise Exception("Manubot could not generate citation")
 
-    # parse results as json
+    # Manubot drops ids whose lookup raised (e.g. timed out) the same as ids
+    # that don't exist, so a missing id may be a transient failure
+    if not manubot:
+        if remember_failure:
+            record_failure(
+                "manubot", _id, "unresolved", "Manubot could not generate citation",
+                expire=TRANSIENT_FAILURE_EXPIRE,
+            )
+        raise Exception("Manubot could not generate citation")
+
     try:
-        manubot = json.loads(output[0])[0]
-    except Exception:
+        return manubot_to_citation(_id, manubot)
+    except Exception as e:
+        if remember_failure:
+            record_failure("manubot", _id, "parse_error", e)
         raise Exception("Couldn't parse Manubot response")
 
+
+def cite_with_manubot_batch(ids, user_ids=()):
+    """
+    generate citation data for many source ids with a single in-process Manubot
+    call, sharing the "manubot" cache with cite_with_manubot. returns dict of
+    id to citation, or to exception if id could not be cited. failures of
+    user_ids (ids entered by user) are neither skipped nor recorded, as with
+    remember_failure off in cite_with_manubot
+    """
+
+    results = {}
+    missing = []
+
+    # get already cited ids from cache
+    for _id in dict.fromkeys(ids):
+        start = time.perf_counter()
+        citation = cache.get(cite_with_manubot.__cache_key__(_id), default=None, retry=True)
+        if citation is not None:
+            record_cache("manubot", True, time.perf_counter() - start)
+            results[_id] = citation
+            continue
+        # skip id that failed recently
+        failure = _id not in user_ids and cached_failure("manubot", _id)
+        if failure:
+            results[_id] = Exception(failure_message(failure))
+        else:
+            missing.append(_id)
+
+    if not missing:
+        return results
+
+    # run Manubot once for all missing ids
+    start = time.perf_counter()
+    # errors of whole call aren't specific to ids, so those aren't recorded as failures
+    try:
+        items = query_manubot(missing)
+        failed = False
+    except Exception as e:
+        log(e, 3)
+        items = {}
+        failed = True
+
+    # spread time of batch call over its ids
+    seconds = (time.perf_counter() - start) / len(missing)
+    for _id in missing:
+        record_cache("manubot", False, seconds)
+
+    for _id in missing:
+        manubot = items.get(_id)
+        if not manubot:
+            if not failed and _id not in user_ids:
+                record_failure(
+                    "manubot", _id, "unresolved", "Manubot could not generate citation",
+                    expire=TRANSIENT_FAILURE_EXPIRE,
+                )
+            results[_id] = Exception("Manubot could not generate citation")
+            continue
+        try:
+            citation = manubot_to_citation(_id, manubot)
+        except Exception as e:
+            if _id not in user_ids:
+                record_failure("manubot", _id, "parse_error", e)
+            results[_id] = Exception("Couldn't parse Manubot response")
+            continue
+        cache.set(cite_with_manubot.__cache_key__(_id), citation, expire=MANUBOT_EXPIRE, retry=True)
+        results[_id] = citation
+
+    return results
+
+
+def query_manubot(ids):
+    """
+    get CSL items for source ids from Manubot's python api, in one call.
+    returns dict of id to CSL item, omitting ids Manubot could not cite
+    """
+
+    # import here, manubot is slow to import and only needed on cache misses
+    from manubot.cite.citations import Citations
+
+    # attribute requests to id, or to batch as a whole
+    with http_trace.subject(ids[0] if len(ids) == 1 else f"manubot batch of {len(ids)} ids"):
+        citations = Citations(input_ids=ids, prune_csl_items=True, sort_csl_items=False)
+        csl_items = {get_safe(item, "id"): item for item in citations.get_csl_items()}
+
+    # map input ids back to generated items, ids can share a standard id
+    return {
+        _id: csl_items[csl_id]
+        for _id, csl_id in citations.input_to_csl_id.items()
+        if csl_id in csl_items
+    }
+
+
+def manubot_to_citation(_id, manubot):
+    """
+    convert Manubot CSL item into citation with only needed info
+    """
+
     # new citation with only needed info
     citation = {}
 